@@ -0,0 +1,53 @@
+"""
+    Compares the cost of calling a function decorated with report_start_end while PyCounters is disabled to the
+    cost of calling the undecorated function, for functions doing some work and for empty ones.
+
+    usage: python disable_benchmark.py [calls]
+"""
+import sys
+import timeit
+
+import pycounters
+from pycounters import counters
+
+
+def work():
+    return sum(xrange(1000))
+
+
+def short_work():
+    return sum(xrange(100))
+
+
+def empty():
+    pass
+
+
+def best_of(f, calls, repeat=5):
+    """ returns the lowest time per call, in seconds """
+    return min(timeit.repeat(f, number=calls, repeat=repeat)) / calls
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    counter = counters.AverageTimeCounter("disable_bench")
+    pycounters.register_counter(counter)
+    try:
+        print "%10s %14s %14s %14s %10s" % ("function", "plain (ns)", "disabled (ns)", "enabled (ns)", "overhead")
+        for f in [work, short_work, empty]:
+            decorated = pycounters.report_start_end("disable_bench")(f)
+            plain = best_of(f, calls)
+            enabled = best_of(decorated, calls)
+            pycounters.disable()
+            try:
+                disabled = best_of(decorated, calls)
+            finally:
+                pycounters.enable()
+            print "%10s %14.0f %14.0f %14.0f %9.1f%%" % (f.__name__, plain * 1e9, disabled * 1e9, enabled * 1e9,
+                                                        (disabled - plain) / plain * 100)
+    finally:
+        pycounters.unregister_counter(counter=counter)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+    Measures EventDispatcher.dispatch_event throughput as the number of dispatching threads grows.
+
+    usage: python dispatch_benchmark.py [events_per_thread]
+"""
+import sys
+import threading
+import time
+
+from pycounters.base import EventDispatcher, BaseListener
+
+
+class NopListener(BaseListener):
+
+    def report_event(self, name, property, param):
+        pass
+
+
+def run(thread_count, events_per_thread):
+    dispatcher = EventDispatcher()
+    dispatcher.add_listener(NopListener())  # listens to all events
+    dispatcher.add_listener(NopListener(events=["bench"]))
+
+    def target():
+        dispatch = dispatcher.dispatch_event
+        for _ in xrange(events_per_thread):
+            dispatch("bench", "end", None)
+
+    threads = [threading.Thread(target=target) for _ in range(thread_count)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return thread_count * events_per_thread / (time.time() - start)
+
+
+def main():
+    events_per_thread = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print "%8s %16s" % ("threads", "events/sec")
+    for thread_count in [1, 2, 4, 8, 16, 32]:
+        print "%8d %16.0f" % (thread_count, run(thread_count, events_per_thread))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+    Measures how long the collecting leader takes to merge reports of many nodes: merging one report at a time
+    (CounterValueCollection.merge_with) versus merging all at once (CounterValueCollection.merge_all, used by
+    MultiProcessCounterValueCollector.merge_values). merge_all uses numpy if it is installed.
+
+    usage: python merge_benchmark.py [nodes] [counters]
+"""
+import gc
+import random
+import sys
+import time
+
+from pycounters.base import CounterValueCollection
+from pycounters.counters import values
+from pycounters.counters.values import AccumulativeCounterValue, AverageCounterValue, MaxCounterValue, \
+    MinCounterValue
+
+
+def make_reports(nodes, counters):
+    rnd = random.Random(0)
+    value_factories = [
+        lambda: AverageCounterValue(rnd.random(), rnd.randint(0, 100)),
+        lambda: AccumulativeCounterValue(rnd.randint(0, 1000)),
+        lambda: MaxCounterValue(rnd.random()),
+        lambda: MinCounterValue(rnd.random()),
+    ]
+    reports = {}
+    for node in range(nodes):
+        report = CounterValueCollection()
+        for c in range(counters):
+            report["counter_%d" % c] = value_factories[c % len(value_factories)]()
+        reports["node_%d" % node] = report
+    return reports
+
+
+def main():
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    counters = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+
+    print "merging %d nodes x %d counters (numpy %s)" % (nodes, counters,
+                                                          "available" if values.numpy else "not available")
+
+    gc.disable()  # keep collection of the many value objects out of the measurements
+
+    reports = make_reports(nodes, counters)
+    start = time.time()
+    merged = CounterValueCollection()
+    for report in reports.itervalues():
+        merged.merge_with(report)
+    merged.values
+    print "%-12s %8.3f sec" % ("incremental", time.time() - start)
+
+    reports = make_reports(nodes, counters)
+    start = time.time()
+    CounterValueCollection.merge_all(reports.values()).values
+    print "%-12s %8.3f sec" % ("merge_all", time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+    Compares MaxWindowCounter / MinWindowCounter with monotonic deque tracking against scanning the whole window,
+    for a large window. Time is simulated so the window can be filled quickly.
+
+    usage: python minmax_benchmark.py [window_entries] [get_value_calls]
+"""
+import random
+import sys
+import time
+
+from pycounters.counters import MaxWindowCounter, MinWindowCounter
+from pycounters.counters.windows import DequeWindow
+
+
+def simulated(counter_class, tracking):
+    class SimulatedCounter(counter_class):
+        now = 0.0
+
+        def _get_current_time(self):
+            return self.now
+
+        def _create_window(self):
+            if tracking:
+                return super(SimulatedCounter, self)._create_window()
+            return DequeWindow()
+
+    return SimulatedCounter
+
+
+def run(label, counter, window_entries, get_value_calls):
+    rnd = random.Random(0)
+    report = counter.report_event
+    # fill the window
+    for _ in xrange(window_entries):
+        counter.now += 1.0
+        report("bench", "value", rnd.random())
+
+    start = time.time()
+    for _ in xrange(window_entries):
+        counter.now += 1.0  # every new value pushes an old one out
+        report("bench", "value", rnd.random())
+    report_time = (time.time() - start) / window_entries
+
+    start = time.time()
+    for _ in xrange(get_value_calls):
+        counter.now += 1.0
+        counter.get_value()
+    value_time = (time.time() - start) / get_value_calls
+
+    print "%-28s %16.2f %16.3f" % (label, report_time * 1e6, value_time * 1e3)
+
+
+def main():
+    window_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    get_value_calls = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    print "%-28s %16s %16s" % ("counter", "report (usec)", "get_value (ms)")
+    for counter_class in [MaxWindowCounter, MinWindowCounter]:
+        for tracking, label in [(False, "scan"), (True, "monotonic")]:
+            counter = simulated(counter_class, tracking)("bench", window_size=float(window_entries))
+            run("%s %s" % (counter_class.__name__, label), counter, window_entries, get_value_calls)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+    Compares QuantileSketchCounter and HistogramCounter with exact percentiles computed from a deque based window
+    (as AverageWindowCounter keeps it). Reports the relative error of each percentile, the time to report a value
+    and to get the counter value, and the memory held by the window.
+
+    usage: python sketch_benchmark.py [value_count]
+"""
+import math
+import random
+import sys
+import time
+
+from pycounters.counters import AverageWindowCounter, HistogramCounter, QuantileSketchCounter
+
+PERCENTILES = [("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999)]
+
+
+class ExactPercentilesCounter(AverageWindowCounter):
+    """ keeps every value of the window and sorts them on request """
+
+    def _get_value(self):
+        self._trim_window()
+        values = sorted(self.window.values)
+        return dict((name, values[max(int(math.ceil(p * len(values))), 1) - 1]) for name, p in PERCENTILES)
+
+
+def memory(counter):
+    """ approximate number of bytes held by the window """
+    if isinstance(counter, ExactPercentilesCounter):
+        return sum(sys.getsizeof(d) + sum(sys.getsizeof(v) for v in d)
+                   for d in [counter.window.values, counter.window.times])
+    total = 0
+    for slot in counter.window.slots:
+        for store in slot.counter_value.__dict__.values():
+            if isinstance(store, dict):
+                total += sys.getsizeof(store) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in store.items())
+    return total
+
+
+def run(label, counter, values, exact):
+    report = counter.report_event
+    start = time.time()
+    for v in values:
+        report("bench", "value", v)
+    report_time = (time.time() - start) / len(values)
+
+    start = time.time()
+    result = counter.get_value()
+    value_time = time.time() - start
+    result = result if isinstance(result, dict) else result.value
+
+    errors = " ".join("%8.4f" % (abs(result[name] - exact[name]) / exact[name]) for name, p in PERCENTILES)
+    print "%-12s %s %14.2f %16.3f %12.0f" % (label, errors, report_time * 1e6, value_time * 1e3,
+                                            memory(counter) / 1024.0)
+
+
+def main():
+    value_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    rnd = random.Random(0)
+    # payload sizes - a long tailed distribution of unknown range
+    values = [rnd.lognormvariate(8, 2) for _ in xrange(value_count)]
+
+    exact_counter = ExactPercentilesCounter("bench")
+    print "%-12s %s %14s %16s %12s" % ("counter", " ".join("%8s" % name for name, p in PERCENTILES),
+                                       "report (usec)", "get_value (ms)", "memory (KB)")
+    for v in values:
+        exact_counter.report_event("bench", "value", v)
+    exact = exact_counter.get_value()
+
+    run("exact", ExactPercentilesCounter("bench"), values, exact)
+    run("histogram", HistogramCounter("bench"), values, exact)
+    run("ddsketch", QuantileSketchCounter("bench"), values, exact)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+    Times thousands of tasks interleaving on a single thread, like the coroutines of an event loop. Every task
+    reports the start of an event, takes a number of steps (varying between tasks) and reports its end. Timings
+    are correct only when events are paired per task (see pycounters.set_task_identity). Pairing them per thread
+    keeps the average (the sum of ends minus the sum of starts is the same for any pairing) but gets the
+    shortest and longest times wrong.
+
+    usage: python task_benchmark.py [tasks]
+"""
+import sys
+import time
+from collections import deque
+
+import pycounters
+from pycounters import counters
+from pycounters.utils.timer import TaskLocalTimer
+
+MAX_STEPS = 20
+
+
+class Scheduler(object):
+    """ runs generator based tasks round robin, one step at a time """
+
+    def __init__(self):
+        self.current = None
+        self.ticks = 0
+
+    def run(self, tasks):
+        ready = deque(tasks)
+        while ready:
+            task = ready.popleft()
+            self.current = task
+            try:
+                task.next()
+            except StopIteration:
+                continue
+            finally:
+                self.ticks += 1
+            ready.append(task)
+        self.current = None
+
+
+class TickTimer(TaskLocalTimer):
+    """ measures time in scheduler ticks """
+
+    def __init__(self, scheduler):
+        super(TickTimer, self).__init__()
+        self.scheduler = scheduler
+
+    def _get_current_time(self):
+        return self.scheduler.ticks
+
+
+def task(handle, steps, scheduler, durations):
+    handle.start()
+    start = scheduler.ticks
+    for _ in xrange(steps):
+        yield
+    durations.append(scheduler.ticks - start)
+    handle.end()
+
+
+def run(task_count, per_task):
+    scheduler = Scheduler()
+    counter = counters.SummaryTimeCounter("task_bench")
+    counter.timer = TickTimer(scheduler)
+    pycounters.register_counter(counter)
+    if per_task:
+        pycounters.set_task_identity(lambda: scheduler.current)
+    try:
+        handle = pycounters.event_handle("task_bench")
+        start = time.time()
+        durations = []
+        scheduler.run([task(handle, i % MAX_STEPS + 1, scheduler, durations) for i in xrange(task_count)])
+        elapsed = time.time() - start
+        summary = counter.get_value().value
+        return (summary["min"], summary["max"]), (min(durations), max(durations)), task_count / elapsed
+    finally:
+        pycounters.set_task_identity(None)
+        pycounters.unregister_counter(counter=counter)
+
+
+def main():
+    task_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print "%10s %22s %22s %12s" % ("pairing", "min/max (ticks)", "actual min/max", "tasks/sec")
+    for per_task in [False, True]:
+        measured, actual, rate = run(task_count, per_task)
+        print "%10s %22s %22s %12.0f" % ("task" if per_task else "thread", "%d/%d" % measured, "%d/%d" % actual,
+                                         rate)
+
+
+if __name__ == "__main__":
+    main()
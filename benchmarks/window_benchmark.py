@@ -0,0 +1,65 @@
+"""
+    Compares the deque based and the bucketed storage of window counters: memory held by the window, time to
+    report an event and time to get the counter value. Time is simulated so the window can be filled quickly.
+
+    usage: python window_benchmark.py [events_per_sec] [window_size] [buckets]
+"""
+import sys
+import time
+
+from pycounters.counters import AverageWindowCounter
+from pycounters.counters.windows import DequeWindow
+
+
+class SimulatedTimeCounter(AverageWindowCounter):
+    now = 0.0
+
+    def _get_current_time(self):
+        return self.now
+
+
+def window_memory(window):
+    """ approximate number of bytes held by the window storage """
+    if isinstance(window, DequeWindow):
+        stores = [window.values, window.times]
+    else:
+        stores = [window.slots] + [s.__dict__ for s in window.slots]
+    total = 0
+    for store in stores:
+        total += sys.getsizeof(store)
+        items = store.itervalues() if isinstance(store, dict) else iter(store)
+        total += sum(sys.getsizeof(i) for i in items)
+    return total
+
+
+def run(label, counter, events_per_sec, window_size):
+    event_count = int(events_per_sec * window_size)
+    step = 1.0 / events_per_sec
+    report = counter.report_event
+    start = time.time()
+    for i in xrange(event_count):
+        counter.now += step
+        report("bench", "value", float(i % 100))
+    report_time = (time.time() - start) / event_count
+
+    start = time.time()
+    counter.get_value()
+    value_time = time.time() - start
+
+    print "%-10s %12d %16.2f %16.3f %14.0f" % (label, event_count, report_time * 1e6, value_time * 1e3,
+                                                window_memory(counter.window) / 1024.0)
+
+
+def main():
+    events_per_sec = float(sys.argv[1]) if len(sys.argv) > 1 else 5000.0
+    window_size = float(sys.argv[2]) if len(sys.argv) > 2 else 300.0
+    buckets = int(sys.argv[3]) if len(sys.argv) > 3 else 60
+
+    print "%-10s %12s %16s %16s %14s" % ("storage", "events", "report (usec)", "get_value (ms)", "memory (KB)")
+    run("deque", SimulatedTimeCounter("bench", window_size=window_size), events_per_sec, window_size)
+    run("buckets", SimulatedTimeCounter("bench", window_size=window_size, buckets=buckets), events_per_sec,
+        window_size)
+
+
+if __name__ == "__main__":
+    main()
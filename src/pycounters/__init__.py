@@ -17,23 +17,31 @@ def report_start(name):
     """ reports an event's start.
         NOTE: you *must*  fire off a corresponding event end with report_end
     """
-    base.THREAD_DISPATCHER.dispatch_event(name, "start", None)
+    base.report_event(name, "start", None)
 
 
 def report_end(name):
     """ reports an event's end.
         NOTE: you *must* have fired off a corresponding event start with report_start
     """
-    base.THREAD_DISPATCHER.dispatch_event(name, "end", None)
+    base.report_event(name, "end", None)
 
 
-def report_start_end(name=None):
+def report_start_end(name=None, sample_rate=None, generator=False):
     """
      returns a function decorator and/or context manager which raises start and end events.
      If name is None events name is set to the name of the decorated function. In that case report_start_end
      can not be used as a context manager.
+
+     sample_rate - report only this fraction (0 < sample_rate <= 1) of the calls, chosen at random. Other calls
+        skip the counters altogether. Counters of events and totals scale their values accordingly. Defaults to the
+        rate given when registering the event's counter (see register_counter).
+
+     generator - set to True when decorating a generator function. The start event is then raised when the
+        generator produces its first item and the end event when it is exhausted or closed, rather than around the
+        creation of the generator.
     """
-    return _reporting_decorator_context_manager(name)
+    return _reporting_decorator_context_manager(name, sample_rate=sample_rate, generator=generator)
 
 
 def report_value(name, value):
@@ -41,13 +49,53 @@ def report_value(name, value):
      reports a value event to the counters.
     """
 
-    base.THREAD_DISPATCHER.dispatch_event(name, "value", value)
+    base.report_event(name, "value", value)
+
+
+def event_handle(name):
+    """
+     returns a handle for reporting events of the given name. The handle has start(), end() and value(value)
+     methods and resolves the counters listening to the event once, instead of on every event.
+    """
+    return base.event_handle(name)
+
+
+def disable(prefix=None):
+    """
+     Stops reporting events to the counters, until enabled again. While disabled, the decorators and context
+     managers of PyCounters cost a single attribute check.
+
+     prefix - if given, only events whose names start with prefix are disabled.
+    """
+    base.set_instrumentation_enabled(False, prefix=prefix)
+
+
+def enable(prefix=None):
+    """
+     Reverses disable(). Without a prefix, turns reporting back on globally, but events of disabled prefixes
+     stay disabled until enabled by the same prefix.
+    """
+    base.set_instrumentation_enabled(True, prefix=prefix)
+
+
+def is_enabled(name):
+    """
+     returns True if events named name are currently reported.
+    """
+    return base.is_event_enabled(name)
 
 
-def register_counter(counter, throw_if_exists=True):
+def register_counter(counter, throw_if_exists=True, sample_rate=None):
     """ Register a counter with PyCounters
+
+        sample_rate - sets the sampling rate of the events the counter listens to (see report_start_end).
     """
+    if sample_rate is not None and not 0 < sample_rate <= 1:
+        raise ValueError("sample_rate must be in (0, 1], got %s" % (sample_rate, ))
     base.GLOBAL_REGISTRY.add_counter(counter, throw=throw_if_exists)
+    if sample_rate is not None:
+        for name in counter.events or []:
+            base.event_handle(name).sample_rate = sample_rate
 
 
 def unregister_counter(counter=None, name=None):
@@ -89,6 +137,50 @@ def unregister_reporter(reporter=None):
     reporters.base.GLOBAL_REPORTING_CONTROLLER.unregister_reporter(reporter)
 
 
+def start_async_dispatch(max_events=10000, policy="drop"):
+    """
+        Dispatch events to counters on a background thread instead of on the reporting thread. Events are queued
+        with the time they were reported at, so timing counters stay accurate.
+
+        :param max_events: the maximum number of queued events.
+        :param policy: what to do with events reported when the queue is full. "drop" drops them, counting them as
+            values of the pycounters.dropped_events event (register a TotalCounter by that name to report them).
+            "block" blocks the reporting thread until there is room.
+    """
+    dispatcher = base.GLOBAL_DISPATCHER
+    with dispatcher.lock:
+        if dispatcher.queue is not None:
+            raise Exception("Asynchronous dispatching is already active.")
+        queue = base.AsyncEventQueue(dispatcher, max_events=max_events, policy=policy)
+        queue.start()
+        dispatcher.queue = queue
+
+
+def stop_async_dispatch():
+    """
+        Stop dispatching events on a background thread. Queued events are dispatched before returning.
+    """
+    dispatcher = base.GLOBAL_DISPATCHER
+    with dispatcher.lock:
+        queue = dispatcher.queue
+        if queue is None:
+            return
+        dispatcher.queue = None
+        queue.stop()
+
+
+def set_task_identity(func=None):
+    """
+        Match the events of tasks rather than threads. Needed when many tasks interleave on a single thread (e.g.
+        greenlets or the coroutines of an event loop), so that the start and end of timed events are paired within
+        each task.
+
+        :param func: a function returning a hashable identity of the currently running task, for example
+            greenlet.getcurrent . None restores the default, the identity of the current thread.
+    """
+    base.set_task_identity(func)
+
+
 def configure_multi_process_collection(collecting_address=[("", 60907), ("", 60906)], timeout_in_sec=120,
                                        role=CollectingRole.AUTO_ROLE):
     """
@@ -1,44 +1,225 @@
+from collections import deque
 from exceptions import NotImplementedError, Exception
+from functools import partial
 import logging
-from threading import RLock, local as thread_local
+from threading import RLock, Lock, Event, Thread, local as thread_local
 import re
+import thread
+import time
 
 
 class EventDispatcher(object):
+    """ dispatches events to listeners. Listener tables are copied on write: add_listener and remove_listener
+        publish a new immutable snapshot so that dispatching never needs to take a lock.
+    """
+
     def __init__(self):
-        self.listeners = dict()
-        self.listeners[None] = set()
         self.lock = RLock()
+        self.listeners = {None: ()}
+        self.queue = None  # an AsyncEventQueue when dispatching asynchronously
 
     def dispatch_event(self, name, property, param):
-        with self.lock:
-            ## dispatch a all registraar os None
-            for l in self.listeners.get(None, []):
-                l.report_event(name, property, param)
+        queue = self.queue
+        if queue is not None:
+            queue.put(name, property, param)
+            return
+        self.dispatch_event_now(name, property, param)
 
-            for l in self.listeners.get(name, []):
-                l.report_event(name, property, param)
+    def dispatch_event_now(self, name, property, param):
+        """ dispatches an event to the listeners on the current thread, even in asynchronous mode """
+        listeners = self.listeners  # a single read of the current snapshot
+        ## dispatch a all registraar os None
+        for l in listeners[None]:
+            l.report_event(name, property, param)
+
+        for l in listeners.get(name, ()):
+            l.report_event(name, property, param)
 
     def add_listener(self, listener):
         with self.lock:
-            if listener.events is None:
-                self.listeners[None].add(listener)
-            else:
-                for event in listener.events:
-                    s = self.listeners.get(event)
-                    if s is None:
-                        s = set()
-                        self.listeners[event] = s
-                    s.add(listener)
+            listeners = dict(self.listeners)
+            for event in self._get_listener_keys(listener):
+                current = listeners.get(event, ())
+                if listener not in current:
+                    listeners[event] = current + (listener, )
+            self.listeners = listeners
 
     def remove_listener(self, listener):
         with self.lock:
-            if listener.events is None:
-                self.listeners[None].remove(listener)
-            else:
-                for event in listener.events:
-                    s = self.listeners.get(event)
-                    s.remove(listener)
+            listeners = dict(self.listeners)
+            for event in self._get_listener_keys(listener):
+                current = listeners.get(event, ())
+                if listener not in current:
+                    raise KeyError(listener)
+                current = tuple(l for l in current if l is not listener)
+                if current or event is None:
+                    listeners[event] = current
+                else:
+                    del listeners[event]
+            self.listeners = listeners
+
+    def _get_listener_keys(self, listener):
+        if listener.events is None:
+            return [None]
+        return listener.events
+
+    def flush(self, timeout=None):
+        """ in asynchronous mode, waits for the events queued so far to be dispatched. """
+        queue = self.queue
+        if queue is not None:
+            queue.flush(timeout=timeout)
+
+
+_task_identity = thread.get_ident
+
+
+def get_task_identity():
+    """ returns the identity of the task currently running. Events of a task are matched (e.g. the start and end
+        of an event timed by a counter) by the identity of the task reporting them. Defaults to the current thread.
+    """
+    return _task_identity()
+
+
+def set_task_identity(func=None):
+    """ sets the function returning the (hashable) identity of the currently running task. Use it when many tasks
+        interleave on a single thread, e.g. greenlet.getcurrent for greenlets. None restores thread identity.
+    """
+    global _task_identity
+    _task_identity = func if func is not None else thread.get_ident
+
+
+class EventContext(thread_local):
+    """ describes the event being dispatched on the current thread: its weight when sampled and, when it is
+        dispatched asynchronously, the original time and task of the event.
+    """
+    time = None  # the time the event was reported. None for events dispatched when reported.
+    origin = None  # the identity of the task which reported the event. None for events dispatched when reported.
+    weight = 1  # the number of events a sampled event stands for (see EventHandle.sample_rate).
+
+
+EVENT_CONTEXT = EventContext()
+
+
+class AsyncEventQueue(object):
+    """ dispatches events on a background thread. Reporting an event appends a
+        (name, property, param, time, thread) tuple to a bounded queue, without locking. The background thread
+        dispatches queued events in batches, setting EVENT_CONTEXT to the original time and task of each.
+
+        max_events - the maximum number of queued events.
+        policy - what to do with events reported when the queue is full:
+            DROP - drop them, counting them in dropped (and as values of the dropped_events_name event).
+            BLOCK - block the reporting thread until there is room.
+    """
+
+    DROP = "drop"
+    BLOCK = "block"
+
+    def __init__(self, dispatcher, max_events=10000, policy=DROP, batch_size=1000, poll_interval=0.01,
+                 dropped_events_name="pycounters.dropped_events"):
+        if policy not in (self.DROP, self.BLOCK):
+            raise ValueError("Unknown policy %s" % (policy, ))
+        self.dispatcher = dispatcher
+        self.max_events = max_events
+        self.policy = policy
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.dropped_events_name = dropped_events_name
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._drop_lock = Lock()
+        self._events = deque()  # append and popleft are atomic
+        self._not_full = Event()
+        self._take_lock = Lock()  # taking events off the queue vs. flush reading the queue position
+        self._taken = 0  # the number of events taken off the queue
+        self._dispatched = 0  # the number of taken events which were dispatched
+        self._running = False
+        self._stopping = False
+        self._drain_lock = Lock()  # dispatching what is left in the queue once stopping
+        self._thread = None
+
+    def put(self, name, property, param):
+        """ queues an event. Called by the reporting thread. """
+        events = self._events
+        if len(events) >= self.max_events and not self._stopping:
+            if self.policy == self.DROP:
+                with self._drop_lock:
+                    self.dropped += 1
+                return
+            while len(events) >= self.max_events and self._running:
+                self._not_full.clear()
+                self._not_full.wait(self.poll_interval)
+        events.append((name, property, param, time.time(), _task_identity(), EVENT_CONTEXT.weight))
+        if self._stopping:
+            # raced with stop(), which may have drained the queue before the event was appended.
+            self._drain()
+
+    def start(self):
+        """ starts the background thread """
+        self._running = True
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ stops the background thread, after dispatching the queued events. Events queued while stopping are
+            dispatched by the reporting thread.
+        """
+        self._stopping = True
+        self._running = False
+        self._not_full.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._drain()
+
+    def _drain(self):
+        with self._drain_lock:
+            self._dispatch_batch(None)
+
+    def flush(self, timeout=None):
+        """ waits until the events queued so far are dispatched, or timeout seconds have passed. Events queued
+            after flush is called aren't waited for.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._take_lock:
+            target = self._taken + len(self._events)
+        while self._dispatched < target and self._running:
+            if deadline is not None and time.time() > deadline:
+                return
+            time.sleep(self.poll_interval / 10)
+
+    def _run(self):
+        while self._running:
+            if not self._events:
+                time.sleep(self.poll_interval)
+                continue
+            self._dispatch_batch(self.batch_size)
+
+    def _dispatch_batch(self, batch_size):
+        events = self._events
+        dispatch = self.dispatcher.dispatch_event_now
+        context = EVENT_CONTEXT
+        # the reporting thread drains the queue while dispatching an event of its own (see put).
+        saved_context = context.time, context.origin, context.weight
+        with self._take_lock:
+            count = len(events) if batch_size is None else min(len(events), batch_size)
+            batch = [events.popleft() for _ in xrange(count)]
+            self._taken += count
+        try:
+            for name, property, param, context.time, context.origin, context.weight in batch:
+                try:
+                    dispatch(name, property, param)
+                except Exception:
+                    logging.getLogger(__name__).exception("Failed dispatching event %s %s", name, property)
+        finally:
+            context.time, context.origin, context.weight = saved_context
+            self._dispatched += count
+            self._not_full.set()
+
+        dropped = self.dropped
+        if dropped != self._reported_dropped and self.dropped_events_name:
+            dispatch(self.dropped_events_name, "value", dropped - self._reported_dropped)
+            self._reported_dropped = dropped
 
 
 class CounterRegistry(object):
@@ -50,11 +231,19 @@ class CounterRegistry(object):
         self.registry = dict()
 
     def get_values(self):
+        self.dispatcher.flush(timeout=1.0)
         values_collection = CounterValueCollection()
+        estimated = []
         with self.lock:
             for name, c in self.registry.iteritems():
-                values_collection[name] = c.get_value()
-
+                v = c.collect_value()
+                values_collection[name] = v
+                if getattr(v, "estimated", False):
+                    estimated.append(name)
+
+        if estimated:
+            # reported as __estimated__: a list of the names of counters whose values are estimated.
+            values_collection["__estimated__"] = EstimatedCountersValue(estimated)
         return values_collection
 
     def add_counter(self, counter, throw=True):
@@ -93,29 +282,72 @@ class CounterRegistry(object):
             return c
 
 
-class ThreadSpecificDispatcher(thread_local):
-    """ A dispatcher handle thread specific dispatching. Also percolates to Global event"""
+class _ThreadListeners(set):
+    """ the listeners of a thread. Discounts them from the active listeners when the thread ends, as its thread
+        local storage is released.
+    """
+
+    def __del__(self):
+        if self:
+            with ThreadSpecificDispatcher._count_lock:
+                ThreadSpecificDispatcher.active_listeners_count -= len(self)
+
+
+class ThreadSpecificDispatcher(object):
+    """ A dispatcher handle thread specific dispatching. Also percolates to Global event.
+        Listeners are kept per thread or, once a task identity is set (see set_task_identity), per task. Listeners
+        of a task must be removed before the task ends.
+    """
     ## TODO: work in progress. no clean solution yet.
 
-    def _get_listner_set(self):
-        if not hasattr(self, "listeners"):
-            self.listeners = set()  # new thread
+    # number of thread specific listeners over all threads. Allows skipping the task lookup when zero.
+    active_listeners_count = 0
+    _count_lock = RLock()
 
-        return self.listeners
+    def __init__(self):
+        self._thread = thread_local()
+        self._task_listeners = dict()  # task identity -> set of listeners, with a task identity set
+
+    def _get_listner_set(self, create=False):
+        if _task_identity is thread.get_ident:
+            ls = getattr(self._thread, "listeners", None)
+            if ls is None and create:
+                ls = self._thread.listeners = _ThreadListeners()  # new thread
+            return ls
+        task = _task_identity()
+        ls = self._task_listeners.get(task)
+        if ls is None and create:
+            ls = self._task_listeners[task] = set()
+        return ls
 
     def add_listener(self, listener):
-        self._get_listner_set().add(listener)
+        with self._count_lock:
+            ls = self._get_listner_set(create=True)
+            if listener not in ls:
+                ls.add(listener)
+                ThreadSpecificDispatcher.active_listeners_count += 1
 
     def remove_listener(self, listener):
-        self._get_listner_set().remove(listener)
-
-    def dispatch_event(self, name, property, param):
-        # first event specific
+        with self._count_lock:
+            ls = self._get_listner_set()
+            if ls is None:
+                raise KeyError(listener)
+            ls.remove(listener)
+            if not ls and _task_identity is not thread.get_ident:
+                del self._task_listeners[_task_identity()]
+            ThreadSpecificDispatcher.active_listeners_count -= 1
+
+    def dispatch_thread_event(self, name, property, param):
+        """ dispatches an event to the listeners of the current thread only """
         ls = self._get_listner_set()
         if ls:
             for l in ls:
                 l.report_event(name, property, param)
 
+    def dispatch_event(self, name, property, param):
+        # first event specific
+        self.dispatch_thread_event(name, property, param)
+
         # finally dispatch it globally..
         global GLOBAL_DISPATCHER
         GLOBAL_DISPATCHER.dispatch_event(name, property, param)
@@ -127,6 +359,179 @@ GLOBAL_REGISTRY = CounterRegistry(GLOBAL_DISPATCHER)
 THREAD_DISPATCHER = ThreadSpecificDispatcher()
 
 
+class EventHandle(object):
+    """ Reports events of a single name, bypassing the name based lookup done by the dispatchers. The listeners of
+        the event and their handlers are resolved once and re-resolved whenever listeners are added or removed.
+
+        Use :func:`event_handle` to get an instance.
+
+        sample_rate - the fraction of start/end pairs reported by the report_start_end decorator and context
+            manager. Other calls are not dispatched at all. Counters of sampled events scale their values, see
+            sampled().
+
+        enabled - False while the event is disabled (see set_instrumentation_enabled). Events of a disabled handle
+            are ignored.
+    """
+
+    sample_rate = 1.0
+
+    def __init__(self, name, dispatcher=None, thread_dispatcher=None):
+        self.name = name
+        self.enabled = is_event_enabled(name)
+        self.dispatcher = dispatcher if dispatcher is not None else GLOBAL_DISPATCHER
+        self.thread_dispatcher = thread_dispatcher if thread_dispatcher is not None else THREAD_DISPATCHER
+        # (listeners snapshot, start handlers, end handlers, value handlers). Replaced as a whole.
+        self._resolved = (None, (), (), ())
+
+    def _resolve(self):
+        listeners = self.dispatcher.listeners
+        resolved = [listeners]
+        for property in ("start", "end", "value"):
+            handlers = []
+            for l in listeners[None] + listeners.get(self.name, ()):
+                handler = l.get_event_handler(self.name, property)
+                if handler is not None:
+                    handlers.append(handler)
+            resolved.append(tuple(handlers))
+
+        self._resolved = resolved = tuple(resolved)
+        return resolved
+
+    def _get_resolved(self):
+        resolved = self._resolved
+        if resolved[0] is not self.dispatcher.listeners:
+            resolved = self._resolve()
+        return resolved
+
+    def start(self):
+        """ reports the start of the event """
+        if self.enabled:
+            self._start()
+
+    def end(self):
+        """ reports the end of the event """
+        if self.enabled:
+            self._end()
+
+    def value(self, value):
+        """ reports a value """
+        if self.enabled:
+            self._value(value)
+
+    # the reporting methods below don't check enabled. The decorators and context managers check it once per call,
+    # so that the end of an event is reported whenever its start was, even if the event is disabled meanwhile.
+    # Start and end events of the generator mode of the decorators carry a param, see TimerMixin.
+
+    def _start(self, param=None):
+        if self.thread_dispatcher.active_listeners_count:
+            self.thread_dispatcher.dispatch_thread_event(self.name, "start", param)
+        queue = self.dispatcher.queue
+        if queue is not None:
+            queue.put(self.name, "start", param)
+            return
+        for handler in self._get_resolved()[1]:
+            handler(param)
+
+    def _end(self, param=None):
+        if self.thread_dispatcher.active_listeners_count:
+            self.thread_dispatcher.dispatch_thread_event(self.name, "end", param)
+        queue = self.dispatcher.queue
+        if queue is not None:
+            queue.put(self.name, "end", param)
+            return
+        for handler in self._get_resolved()[2]:
+            handler(param)
+
+    def _value(self, value):
+        if self.thread_dispatcher.active_listeners_count:
+            self.thread_dispatcher.dispatch_thread_event(self.name, "value", value)
+        queue = self.dispatcher.queue
+        if queue is not None:
+            queue.put(self.name, "value", value)
+            return
+        for handler in self._get_resolved()[3]:
+            handler(value)
+
+    def sampled(self, property, param, rate):
+        """ reports an event which was sampled at the given rate (0 < rate <= 1), so it stands for 1 / rate
+            events. Like the decision to sample, checking enabled is left to the caller.
+        """
+        context = EVENT_CONTEXT
+        context.weight = 1.0 / rate
+        try:
+            getattr(self, "_" + property)(param)
+        finally:
+            context.weight = 1
+
+
+_EVENT_HANDLES = dict()
+_EVENT_HANDLES_LOCK = Lock()
+
+# the instrumentation switches, see set_instrumentation_enabled
+_INSTRUMENTATION_ENABLED = True
+_DISABLED_PREFIXES = frozenset()
+
+
+def event_handle(name):
+    """ returns the (shared) :class:`EventHandle` of the global dispatchers for events named name """
+    handle = _EVENT_HANDLES.get(name)
+    if handle is None:
+        with _EVENT_HANDLES_LOCK:
+            # created under the lock so that the handle can not miss a concurrent switch
+            handle = _EVENT_HANDLES.get(name)
+            if handle is None:
+                handle = _EVENT_HANDLES[name] = EventHandle(name)
+    return handle
+
+
+def report_event(name, property, param):
+    """ reports an event through the (shared) :class:`EventHandle` of its name. Events of names which no listener
+        specifically listens to are dispatched by name instead, so that dynamic names don't fill the handles cache.
+    """
+    handle = _EVENT_HANDLES.get(name)
+    if handle is None:
+        if name not in GLOBAL_DISPATCHER.listeners:
+            if is_event_enabled(name):
+                THREAD_DISPATCHER.dispatch_event(name, property, param)
+            return
+        handle = event_handle(name)
+    if handle.enabled:
+        getattr(handle, "_" + property)(param)
+
+
+def is_event_enabled(name):
+    """ returns False if events named name are disabled, either globally or by one of the disabled prefixes """
+    if not _INSTRUMENTATION_ENABLED:
+        return False
+    for prefix in _DISABLED_PREFIXES:
+        if name.startswith(prefix):
+            return False
+    return True
+
+
+def set_instrumentation_enabled(enabled, prefix=None):
+    """ turns reporting of events on or off.
+
+        prefix - if given, only events whose names start with prefix are switched. Otherwise all events are
+            switched, while the prefix switches are kept. An event is reported only if it is enabled both globally
+            and by all prefixes.
+
+        The outcome is stored on the event handles (EventHandle.enabled), so that checking it costs a single
+        attribute read on every event.
+    """
+    global _INSTRUMENTATION_ENABLED, _DISABLED_PREFIXES
+    with _EVENT_HANDLES_LOCK:
+        if prefix is None:
+            _INSTRUMENTATION_ENABLED = bool(enabled)
+        elif enabled:
+            _DISABLED_PREFIXES = _DISABLED_PREFIXES - frozenset([prefix])
+        else:
+            _DISABLED_PREFIXES = _DISABLED_PREFIXES | frozenset([prefix])
+
+        for handle in _EVENT_HANDLES.itervalues():
+            handle.enabled = is_event_enabled(handle.name)
+
+
 class BaseListener(object):
 
     def __init__(self, events=None):
@@ -139,6 +544,12 @@ class BaseListener(object):
         """ reports an event to this listener """
         raise NotImplementedError("report_event is not implemented")
 
+    def get_event_handler(self, name, property):
+        """ returns a function accepting the event param which handles events of the given name and property,
+            or None if such events are ignored. Used by :class:`EventHandle` to resolve listeners once.
+        """
+        return partial(self.report_event, name, property)
+
 
 class EventLogger(BaseListener):
     """Ask boaz what it is for"""
@@ -175,6 +586,9 @@ class CounterValueBase(object):
     """ a base class for counter values. Deals with defining merge semantics etc.
     """
 
+    # set to True on values computed from sampled data. See CounterRegistry.get_values
+    estimated = False
+
     def __init__(self, value):
         self.value = value
 
@@ -183,6 +597,44 @@ class CounterValueBase(object):
         """
         raise NotImplementedError("merge_with should be implemented in class inheriting from CounterValueBase")
 
+    @classmethod
+    def merge_groups(cls, groups):
+        """ merges many groups of values of this class at once. groups is a list of lists of values, the result is
+            a list with a merged value per group. The first value of each group may be reused for the result.
+            Override to reduce all groups in one pass. The default merges values one by one.
+        """
+        ret = []
+        for values in groups:
+            merged = values[0]
+            for v in values[1:]:
+                merged.merge_with(v)
+            ret.append(merged)
+        return ret
+
+
+class EstimatedCountersValue(CounterValueBase):
+    """ the names of counters whose values were estimated from sampled data. Merged by joining the names.
+    """
+
+    def __init__(self, names):
+        self.names = set(names)
+
+    @property
+    def value(self):
+        return sorted(self.names)
+
+    def merge_with(self, other_counter_value):
+        """ updates this CounterValue with information of another. Used for multiprocess reporting
+        """
+        self.names.update(other_counter_value.names)
+
+
+class CompositeCounterValue(CounterValueBase):
+    """ a base class for counter values made of several named values. The value property should return a
+        dictionary of them. Reporters get each named value separately, as COUNTER_NAME.VALUE_NAME .
+    """
+    pass
+
 
 class CounterValueCollection(dict):
     """ a dictionary of counter values, adding support for dictionary merges and getting a value only dict.
@@ -192,10 +644,55 @@ class CounterValueCollection(dict):
     def values(self):
         r = {}
         for k, v in self.iteritems():
-            r[k] = v.value if hasattr(v, "value") else v
+            if isinstance(v, CompositeCounterValue):
+                for sub_k, sub_v in v.value.iteritems():
+                    r[k + "." + sub_k] = sub_v
+            else:
+                r[k] = v.value if hasattr(v, "value") else v
 
         return r
 
+    @classmethod
+    def merge_all(cls, collections):
+        """ merges a list of collections into a new collection. Gives the same result as merging them one by one
+            into an empty collection, but groups values by their class and merges each class in one pass
+            (see CounterValueBase.merge_groups). Values of the merged collections may be reused in the result.
+        """
+        keys = set()
+        for collection in collections:
+            keys.update(collection)
+        keys = list(keys)
+        # a tuple per key, with the value of every collection. None where the collection doesn't have the key.
+        rows = zip(*[map(collection.get, keys) for collection in collections])
+
+        merged = cls()
+        groups = {}  # class -> (keys, groups of values)
+        for k, values in zip(keys, rows):
+            if None in values:
+                values = [v for v in values if v is not None]
+                if not values:
+                    merged[k] = None
+                    continue
+            value_class = type(values[0])
+            if len(values) == 1:
+                merged[k] = values[0]
+            elif issubclass(value_class, CounterValueBase) and len(set(map(type, values))) == 1:
+                keys, value_groups = groups.setdefault(value_class, ([], []))
+                keys.append(k)
+                value_groups.append(values)
+            else:
+                # mixed or unmergeable values. Let merge_with handle (or complain about) them.
+                single = cls()
+                for v in values:
+                    single.merge_with({k: v})
+                merged[k] = single[k]
+
+        for value_class, (keys, value_groups) in groups.iteritems():
+            for k, v in zip(keys, value_class.merge_groups(value_groups)):
+                merged[k] = v
+
+        return merged
+
     def merge_with(self, other_counter_value_collection):
         for k, v in other_counter_value_collection.iteritems():
             mv = self.get(k)
@@ -6,12 +6,35 @@ __all__ = ["TotalCounter",
             "MinWindowCounter",
             "AverageTimeCounter",
             "EventCounter",
-            "ValueAccumulator"
+            "ValueAccumulator",
+            "HistogramCounter",
+            "HistogramTimeCounter",
+            "QuantileSketchCounter",
+            "EWMARateCounter",
+            "EWMAAverageCounter",
+            "SummaryCounter",
+            "SummaryTimeCounter",
+            "VarianceWindowCounter",
+            "VarianceTimeCounter",
+            "CardinalityCounter",
+            "TopKCounter",
+            "ConcurrencyCounter",
+            "MultiAverageWindowCounter",
+            "MultiAverageTimeCounter",
+            "CounterFamily"
             ]
 
 from .types import TotalCounter, AverageWindowCounter,\
     FrequencyCounter, WindowCounter, MaxWindowCounter,\
-    MinWindowCounter,AverageTimeCounter, EventCounter, ValueAccumulator
+    MinWindowCounter,AverageTimeCounter, EventCounter, ValueAccumulator,\
+    HistogramCounter, HistogramTimeCounter, QuantileSketchCounter, EWMARateCounter, EWMAAverageCounter,\
+    SummaryCounter, SummaryTimeCounter,\
+    VarianceWindowCounter, VarianceTimeCounter,\
+    CardinalityCounter,\
+    TopKCounter,\
+    ConcurrencyCounter,\
+    MultiAverageWindowCounter, MultiAverageTimeCounter,\
+    CounterFamily
 
 # Backward compatibility
 from ..utils.threads import ThreadTimeCategorizer
@@ -1,18 +1,22 @@
-from collections import deque
 from exceptions import NotImplementedError
+from functools import partial
+import math
 from time import time
-from ..base import BaseListener
-from threading import RLock
+from ..base import BaseListener, EVENT_CONTEXT
+from threading import RLock, Lock, current_thread, local as thread_local
+from .windows import DequeWindow, BucketWindow, DeltaWindow
 
 
 class BaseCounter(BaseListener):
 
-    def __init__(self, name, events=None):
+    def __init__(self, name, events=None, delta=False):
         """
            name - name of counter
            events - events this counter should count. can be
                 None - defaults to events called the same as counter name
                 [event, event, ..] - a list of events to listen to
+           delta - if True, the counter is cleared whenever its value is collected for a report, so every report
+                covers the events since the previous one.
         """
         self.name = name
         if events is None:
@@ -20,12 +24,29 @@ class BaseCounter(BaseListener):
         super(BaseCounter, self).__init__(events=events)
 
         self.lock = RLock()
+        self.delta = delta
+        self.sample_rate = None  # the sampling rate of the last event, None if not sampled. See _scale_sampled
 
     def report_event(self, name, property, param):
         """ reports an event to this counter """
         with self.lock:
             self._report_event(name, property, param)
 
+    def get_event_handler(self, name, property):
+        """ returns a function accepting the event param, which handles events of the given name and property
+            under the counter lock. None if the counter ignores these events.
+        """
+        handler = self._get_event_handler(name, property)
+        if handler is None:
+            return None
+        lock = self.lock
+
+        def locked_handler(param):
+            with lock:
+                handler(param)
+
+        return locked_handler
+
     def get_value(self):
         """
          gets the value of this counter
@@ -33,16 +54,33 @@ class BaseCounter(BaseListener):
         with self.lock:
             return self._get_value()
 
+    def collect_value(self):
+        """
+         gets the value of this counter for a report. In delta mode, the counter is cleared under the same lock, so
+         no event is lost or reported twice.
+        """
+        with self.lock:
+            value = self._get_value()
+            if self.delta:
+                self._clear()
+                self.sample_rate = None
+            return value
+
     def clear(self, dump=True):
         """ Clears the stored information
         """
         with self.lock:
             self._clear()
+            self.sample_rate = None
 
     def _report_event(self, name, property, param):
         """ implement this in sub classes """
         raise NotImplementedError("_report_event is not implemented")
 
+    def _get_event_handler(self, name, property):
+        """ returns an unlocked function accepting the event param. Override to resolve handlers in advance. """
+        return partial(self._report_event, name, property)
+
     def _get_value(self):
         """ implement this in sub classes """
         raise NotImplementedError("_get_value is not implemented")
@@ -51,38 +89,256 @@ class BaseCounter(BaseListener):
         """ implement this in sub classes """
         raise NotImplementedError("_clear is not implemented")
 
+    def _get_current_time(self):
+        return time()
+
+    def _scale_sampled(self, value):
+        """ scales the value of a sampled event (see EventHandle.sample_rate) by the number of events it stands
+            for, keeping totals and rates unbiased. Records the sampling rate, or its end for events which weren't
+            sampled. Call it for sampled events and whenever sample_rate is set.
+        """
+        weight = EVENT_CONTEXT.weight
+        self.sample_rate = 1.0 / weight if weight != 1 else None
+        return value * weight
+
+    def _get_sample_weight(self):
+        """ returns the number of events the reported event stands for: 1 unless it was sampled. See _scale_sampled.
+        """
+        if EVENT_CONTEXT.weight != 1 or self.sample_rate is not None:
+            return self._scale_sampled(1)
+        return 1
+
+    def _get_event_time(self):
+        """ the time of the event being reported. Events dispatched asynchronously keep the time they were
+            reported at (see AsyncEventQueue).
+        """
+        t = EVENT_CONTEXT.time
+        if t is None:
+            return self._get_current_time()
+        return t
+
 
 class BaseWindowCounter(BaseCounter):
-    """ A base class for counters that aggregate data based on a sliding window """
+    """ A base class for counters that aggregate data based on a sliding window
 
-    def __init__(self, name, window_size=300.0, events=None):
-        super(BaseWindowCounter, self).__init__(name, events=events)
+        window_size - the size of the window in seconds
+        buckets - None keeps every value in the window. A number of buckets divides the window into time slots
+            and only keeps an aggregate of each slot. This takes constant memory, regardless of the events rate.
+        delta - if True, the window spans the time since the counter's value was last collected for a report
+            (see BaseCounter.collect_value) and window_size is ignored. Only an aggregate of the values is kept.
+        max_samples - when every value is kept (no buckets), caps the number of values. Beyond it, values are
+            sampled and counts scaled (see DequeWindow). Values reported while sampling have estimated set to True.
+    """
+
+    def __init__(self, name, window_size=300.0, events=None, buckets=None, delta=False, max_samples=None):
+        super(BaseWindowCounter, self).__init__(name, events=events, delta=delta)
         self.window_size = window_size
-        self.values = deque()
-        self.times = deque()
+        self.buckets = buckets
+        self.max_samples = max_samples
+        self.window = self._create_window()
+        if isinstance(self.window, DequeWindow):
+            # backward compatibility
+            self.values = self.window.values
+            self.times = self.window.times
+
+    def _create_window(self):
+        if self.delta:
+            return DeltaWindow(self._get_current_time())
+        if self.buckets:
+            return BucketWindow(self.window_size, self.buckets)
+        return DequeWindow(max_samples=self.max_samples)
+
+    def get_value(self):
+        with self.lock:
+            window = self.window  # may be replaced by collect_value in delta mode
+            return self._flag_estimated(super(BaseWindowCounter, self).get_value(), window)
+
+    def collect_value(self):
+        with self.lock:
+            window = self.window
+            return self._flag_estimated(super(BaseWindowCounter, self).collect_value(), window)
+
+    def _flag_estimated(self, value, window):
+        if window.estimated():
+            value.estimated = True
+        return value
 
     def _clear(self):
-        self.values.clear()
-        self.times.clear()
+        if self.delta:
+            self.window = self._create_window()  # starts a new interval
+        else:
+            self.window.clear()
 
     def _get_value(self):
         """ override this function with your aggregation logic. call base class for data trimming.  """
         self._trim_window()
 
     def _trim_window(self):
-        window_limit = self.get_current_window_start_time()
-        # trim old data
-        while self.times and self.times[0] < window_limit:
-            self.times.popleft()
-            self.values.popleft()
+        self.window.trim(self.get_current_window_start_time())
 
     def _report_event_value(self, param, value):
         self._trim_window()
-        self.values.append(value)
-        self.times.append(self._get_current_time())
-
-    def _get_current_time(self):
-        return time()
+        self.window.add(value, self._get_event_time(), self._get_sample_weight())
 
     def get_current_window_start_time(self):
         return self._get_current_time() - self.window_size
+
+
+class CounterValueSlot(object):
+    """ a time slot of a bucketed window, adding the slot's values to a counter value created by value_factory """
+
+    def __init__(self, value_factory):
+        self.value_factory = value_factory
+        self.reset(None)
+
+    def reset(self, id):
+        self.id = id
+        self.counter_value = self.value_factory()
+
+    def add(self, value, time, weight=1):
+        if weight != 1:
+            self.counter_value.add(value, weight)
+        else:
+            self.counter_value.add(value)
+
+
+class BaseSlotValueWindowCounter(BaseWindowCounter):
+    """ A base class for window counters which aggregate the values of each time slot (see the buckets parameter
+        of BaseWindowCounter) into a counter value, merging the slots' values when reporting. buckets can't be None.
+        Sub classes must implement _create_value , returning counter values whose add(value, count) method adds
+        count values (sampled events stand for several).
+    """
+
+    def _create_window(self):
+        if not self.buckets:
+            raise ValueError("%s requires a number of buckets, got %s" % (self.__class__.__name__, self.buckets))
+        return BucketWindow(self.window_size, self.buckets, slot_class=lambda: CounterValueSlot(self._create_value))
+
+    def _create_value(self):
+        """ implement this in sub classes: returns an empty counter value """
+        raise NotImplementedError("_create_value is not implemented")
+
+    def _get_value(self):
+        super(BaseSlotValueWindowCounter, self)._get_value()
+        v = self._create_value()
+        for slot in self.window.get_slots():
+            v.merge_with(slot.counter_value)
+        return v
+
+
+class BaseEWMACounter(BaseCounter):
+    """ A base class for counters that keep exponentially weighted moving averages (like the Unix load average) of
+        the sum and count of values, using constant memory. Values are collected into ticks of tick_interval
+        seconds. At the end of every tick, the averages of each horizon are updated with the tick's sum and count.
+
+        horizons - a list of (name, seconds) tuples, the time constants of the averages.
+    """
+
+    def __init__(self, name, events=None, tick_interval=5.0, horizons=[("1m", 60.0), ("5m", 300.0), ("15m", 900.0)]):
+        self.tick_interval = float(tick_interval)
+        self.horizons = horizons
+        self.alphas = [1 - math.exp(-self.tick_interval / seconds) for horizon, seconds in horizons]
+        self._clear()
+        super(BaseEWMACounter, self).__init__(name, events=events)
+
+    def _clear(self):
+        self.last_tick = None
+        self.tick_sum = 0.0
+        self.tick_count = 0
+        # averages per horizon. None until the first tick ends.
+        self.average_sums = None
+        self.average_counts = None
+
+    def _tick(self, now=None):
+        """ closes all ticks that ended by now, the current time by default """
+        if now is None:
+            now = self._get_current_time()
+        if self.last_tick is None:
+            self.last_tick = now
+            return
+
+        ticks = int((now - self.last_tick) // self.tick_interval)
+        if ticks < 1:
+            return
+        self.last_tick += ticks * self.tick_interval
+
+        if self.average_sums is None:
+            self.average_sums = [self.tick_sum] * len(self.alphas)
+            self.average_counts = [float(self.tick_count)] * len(self.alphas)
+        else:
+            for i, alpha in enumerate(self.alphas):
+                self.average_sums[i] += alpha * (self.tick_sum - self.average_sums[i])
+                self.average_counts[i] += alpha * (self.tick_count - self.average_counts[i])
+
+        if ticks > 1:
+            # ticks without any values just decay the averages
+            for i, alpha in enumerate(self.alphas):
+                decay = (1 - alpha) ** (ticks - 1)
+                self.average_sums[i] *= decay
+                self.average_counts[i] *= decay
+
+        self.tick_sum = 0.0
+        self.tick_count = 0
+
+    def _report_event_value(self, name, value):
+        # events dispatched asynchronously are added to the tick they were reported in, unless already closed.
+        self._tick(self._get_event_time())
+        weight = self._get_sample_weight()
+        if weight != 1:
+            self.tick_sum += value * weight
+        else:
+            self.tick_sum += value
+        self.tick_count += weight
+
+    def _get_averages(self, averages):
+        """ returns a dictionary of horizon name to its value in averages (None before the first tick ends).
+            Call _tick first.
+        """
+        if averages is None:
+            averages = [None] * len(self.horizons)
+        return dict((horizon, a) for (horizon, seconds), a in zip(self.horizons, averages))
+
+
+class ThreadShards(object):
+    """ Keeps a separate state object (a shard) per thread, so threads can update their own shard without locking.
+        shard_factory is called to create the shard of a thread on its first use.
+    """
+
+    def __init__(self, shard_factory):
+        self.shard_factory = shard_factory
+        self.lock = Lock()
+        self._local = thread_local()
+        self._shards = []  # (thread, shard) tuples
+
+    def get(self):
+        """ returns the shard of the current thread """
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self.shard_factory()
+            with self.lock:
+                self._shards.append((current_thread(), shard))
+            self._local.shard = shard
+            return shard
+
+    def collect(self):
+        """ returns a tuple of two lists: shards of running threads and shards of threads which have exited
+            since the last call. The latter are no longer tracked, the caller should fold them into its own state.
+        """
+        live = []
+        retired = []
+        with self.lock:
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    retired.append(shard)
+            self._shards = live
+
+        return [shard for thread, shard in live], retired
+
+    def clear(self):
+        """ drops all shards. Threads will get new shards upon their next use. """
+        with self.lock:
+            self._local = thread_local()
+            self._shards = []
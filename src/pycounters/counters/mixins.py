@@ -1,4 +1,8 @@
-from ..utils.timer import ThreadLocalTimer
+from exceptions import NotImplementedError
+from functools import partial
+from ..base import EVENT_CONTEXT
+from ..utils.timer import TaskLocalTimer
+from .base import ThreadShards
 
 
 class AutoDispatch(object):
@@ -24,21 +28,68 @@ class AutoDispatch(object):
         if handler:
             handler(name, param)
 
+    def _get_event_handler(self, name, property):
+        handler = self.dispatch_dict.get(property)
+        if not handler:
+            return None
+        return partial(handler, name)
+
 
 class TimerMixin(AutoDispatch):
+    """ times events from their start to their end, separately for every task (thread by default, see
+        pycounters.base.set_task_identity). Nested events (e.g. recursive calls) are timed separately, each from its
+        own start. Pass exclusive=True to the constructor to leave the time of nested events out of the enclosing
+        one's.
+
+        Events with a param are timed by whoever reports them (e.g. the generator mode of the report_start_end
+        decorator), as their starts and ends may interleave in any order: the end's param is the elapsed time and
+        the start is ignored. These events don't count as nested time.
+    """
 
     def __init__(self, *args, **kwargs):
+        self.exclusive = kwargs.pop("exclusive", False)
         self.timer = None
+        # timings of events dispatched asynchronously, by the task which reported them:
+        # a stack of [start time, time of nested events]
+        self._async_start_times = dict()
         super(TimerMixin, self).__init__(*args, **kwargs)
 
     def _report_event_start(self, name, param):
+        if param is not None:
+            return
+        if EVENT_CONTEXT.origin is not None:
+            self._async_start_times.setdefault(EVENT_CONTEXT.origin, []).append([EVENT_CONTEXT.time, 0.0])
+            return
+
         if not self.timer:
-            self.timer = ThreadLocalTimer()
+            self.timer = TaskLocalTimer()
 
         self.timer.start()
 
     def _report_event_end(self, name, param):
-        self._report_event(name, "value", self.timer.stop())
+        if param is not None:
+            self._report_event(name, "value", param)
+            return
+        if EVENT_CONTEXT.origin is not None:
+            self._report_async_event_end(name)
+            return
+
+        t = self.timer.stop(exclusive=True) if self.exclusive else self.timer.stop()
+        if t is not None:  # None for an end without a start
+            self._report_event(name, "value", t)
+
+    def _report_async_event_end(self, name):
+        origin = EVENT_CONTEXT.origin
+        timings = self._async_start_times.get(origin)
+        if not timings:
+            return
+        start_time, nested = timings.pop()
+        t = EVENT_CONTEXT.time - start_time
+        if timings:
+            timings[-1][1] += t
+        else:
+            del self._async_start_times[origin]
+        self._report_event(name, "value", t - nested if self.exclusive else t)
 
 
 class TriggerMixin(AutoDispatch):
@@ -47,3 +98,33 @@ class TriggerMixin(AutoDispatch):
 
     def _report_event_end(self, name, param):
         self._report_event(name, "value", 1L)
+
+
+class ShardedMixin(object):
+    """ a mixin for counters which can keep their state in per thread shards. Pass sharded=True to the constructor
+        to activate. In that mode events are reported without taking the counter lock and the class is expected to
+        store them in the shard returned by self.shards.get() . The shards are merged when the value is requested.
+        Sub classes must implement _create_shard .
+    """
+
+    def __init__(self, *args, **kwargs):
+        sharded = kwargs.pop("sharded", False)
+        if sharded and kwargs.get("delta"):
+            raise ValueError("sharded counters don't support delta mode")
+        self.shards = ThreadShards(self._create_shard) if sharded else None
+        super(ShardedMixin, self).__init__(*args, **kwargs)
+
+    def report_event(self, name, property, param):
+        if self.shards is None:
+            super(ShardedMixin, self).report_event(name, property, param)
+        else:
+            self._report_event(name, property, param)
+
+    def get_event_handler(self, name, property):
+        if self.shards is None:
+            return super(ShardedMixin, self).get_event_handler(name, property)
+        return self._get_event_handler(name, property)
+
+    def _create_shard(self):
+        """ implement this in sub classes """
+        raise NotImplementedError("_create_shard is not implemented")
@@ -1,33 +1,97 @@
+import math
+from collections import deque, OrderedDict
 from copy import copy
-from ..base import THREAD_DISPATCHER
-from .base import BaseCounter, BaseWindowCounter
-from .mixins import AutoDispatch, TimerMixin, TriggerMixin
+from ..base import THREAD_DISPATCHER, EVENT_CONTEXT, event_handle
+from .base import BaseCounter, BaseWindowCounter, BaseEWMACounter, BaseSlotValueWindowCounter
+from .windows import DequeWindow, BucketWindow
+from .mixins import AutoDispatch, TimerMixin, TriggerMixin, ShardedMixin
 from .values import AccumulativeCounterValue, AverageCounterValue,\
-    MinCounterValue, MaxCounterValue
+    MinCounterValue, MaxCounterValue, HistogramCounterValue, QuantileSketchCounterValue,\
+    EWMARateCounterValue, EWMAAverageCounterValue, SummaryCounterValue, VarianceCounterValue,\
+    CardinalityCounterValue, TopKCounterValue, ConcurrencyCounterValue,\
+    MultiAverageCounterValue, FamilyCounterValue
 
 __author__ = 'boaz'
 
 
-class TotalCounter(AutoDispatch, BaseCounter):
+class _AccumulatorShard(object):
+    """ per thread state of sharded TotalCounter and EventCounter """
+
+    def __init__(self):
+        self.value = None
+
+    def add(self, value, sampled=False):
+        if self.value:
+            self.value += value
+        elif sampled:
+            self.value = value
+        else:
+            self.value = long(value)
+
+
+def _get_accumulated_shards_value(counter):
+    """ merges the shards of a sharded TotalCounter or EventCounter. Shards of exited threads are folded into
+        counter.value.
+    """
+    live, retired = counter.shards.collect()
+    v = AccumulativeCounterValue(counter.value, counter.sample_rate)
+    for shard in retired:
+        v.merge_with(AccumulativeCounterValue(shard.value, counter.sample_rate))
+    counter.value = v.value
+    for shard in live:
+        v.merge_with(AccumulativeCounterValue(shard.value, counter.sample_rate))
+    return v
+
+
+class _WindowShard(object):
+    """ per thread state of sharded window counters. Only the owning thread removes items as long as it runs. """
+
+    def __init__(self):
+        self.events = deque()  # (time, value) tuples
+
+    def trim(self, window_limit):
+        events = self.events
+        while events and events[0][0] < window_limit:
+            events.popleft()
+
+
+class TotalCounter(ShardedMixin, AutoDispatch, BaseCounter):
     """ Counts the total of events' values.
+
+        Pass sharded=True to accumulate values in per thread shards, without locking. Pass delta=True to report
+        the total of the events since the previous report.
     """
 
-    def __init__(self, name, events=None):
+    def __init__(self, name, events=None, sharded=False, delta=False):
         self.value = None
-        super(TotalCounter, self).__init__(name, events=events)
+        super(TotalCounter, self).__init__(name, events=events, sharded=sharded, delta=delta)
+
+    def _create_shard(self):
+        return _AccumulatorShard()
 
     def _get_value(self):
-        return AccumulativeCounterValue(self.value)
+        if self.shards is not None:
+            return _get_accumulated_shards_value(self)
+        return AccumulativeCounterValue(self.value, self.sample_rate)
 
     def _report_event_value(self, name, value):
+        sampled = EVENT_CONTEXT.weight != 1
+        if sampled or self.sample_rate is not None:
+            value = self._scale_sampled(value)
 
-        if self.value:
+        if self.shards is not None:
+            self.shards.get().add(value, sampled)
+        elif self.value:
             self.value += value
+        elif sampled:
+            self.value = value
         else:
             self.value = long(value)
 
     def _clear(self):
         self.value = 0L
+        if self.shards is not None:
+            self.shards.clear()
 
 
 class AverageWindowCounter(AutoDispatch, BaseWindowCounter):
@@ -35,94 +99,444 @@ class AverageWindowCounter(AutoDispatch, BaseWindowCounter):
 
     def _get_value(self):
         super(AverageWindowCounter, self)._get_value()
-        if not self.values:
+        count = self.window.count()
+        if not count:
             v = None
         else:
-            v = sum(self.values, 0.0) / len(self.values)
+            v = self.window.sum() / count
+
+        return AverageCounterValue(v, count)
+
 
-        return AverageCounterValue(v, len(self.values))
+class MultiAverageWindowCounter(AutoDispatch, BaseWindowCounter):
+    """ Calculates running averages of values over several windows (horizons) at once, reported as
+        COUNTER_NAME.HORIZON_NAME (e.g. my_counter.1m, my_counter.5m and my_counter.15m). Every value is recorded
+        once, in a single bucketed window spanning the longest horizon. The averages of shorter horizons are
+        computed from its latest slots.
+
+        horizons - a list of (name, seconds) tuples.
+        slot_size - the size in seconds of the window's time slots. Defaults to a 12th of the shortest horizon.
+    """
 
+    def __init__(self, name, horizons=[("1m", 60.0), ("5m", 300.0), ("15m", 900.0)], events=None, slot_size=None):
+        self.horizons = horizons
+        if slot_size is None:
+            slot_size = min([seconds for horizon, seconds in horizons]) / 12.0
+        window_size = max([seconds for horizon, seconds in horizons])
+        buckets = int(math.ceil(window_size / slot_size))
+        super(MultiAverageWindowCounter, self).__init__(name, window_size=buckets * slot_size, events=events,
+                                                        buckets=buckets)
+
+    def _get_value(self):
+        super(MultiAverageWindowCounter, self)._get_value()
+        now = self._get_current_time()
+        averages = {}
+        for horizon, seconds in self.horizons:
+            slots = self.window.get_slots(now - seconds)
+            count = sum([s.count for s in slots], 0)
+            if not count:
+                averages[horizon] = AverageCounterValue(None, 0)
+            else:
+                averages[horizon] = AverageCounterValue(sum([s.sum for s in slots], 0.0) / count, count)
+        return MultiAverageCounterValue(averages)
+
+
+class MultiAverageTimeCounter(TimerMixin, MultiAverageWindowCounter):
+    """ Counts the average time between start and end events over several windows. See MultiAverageWindowCounter.
+    """
+    pass
 
-class FrequencyCounter(TriggerMixin, BaseWindowCounter):
+
+class FrequencyCounter(ShardedMixin, TriggerMixin, BaseWindowCounter):
     """ Use to count the frequency of some occurrences in a sliding window. Occurrences can be reported directly
         via a value event (X occurrences has happened now) or via an end event which will be interpreted as a single
         occurrence.
+
+        Pass sharded=True to record occurrences in per thread shards, without locking. Pass delta=True to report
+        the frequency since the previous report.
     """
 
+    def __init__(self, name, window_size=300.0, events=None, buckets=None, sharded=False, delta=False,
+                 max_samples=None):
+        self._retired_shards = []
+        super(FrequencyCounter, self).__init__(name, window_size=window_size, events=events, buckets=buckets,
+                                               sharded=sharded, delta=delta, max_samples=max_samples)
+
+    def _create_shard(self):
+        return _WindowShard()
+
+    def _report_event_value(self, param, value):
+        if self.shards is None:
+            # the window scales the values of sampled events
+            super(FrequencyCounter, self)._report_event_value(param, value)
+            return
+        value *= self._get_sample_weight()
+        now = self._get_event_time()
+        shard = self.shards.get()
+        shard.trim(now - self.window_size)
+        shard.events.append((now, value))
+
     def _get_value(self):
+        if self.shards is not None:
+            return self._get_sharded_value()
         super(FrequencyCounter, self)._get_value()
-        if not self.values or len(self.values) < 1:
-            return AccumulativeCounterValue(0.0)
-        return AccumulativeCounterValue(sum(self.values, 0.0) / (self._get_current_time() - self.times[0]))
+        if self.window.count() < 1:
+            return AccumulativeCounterValue(0.0, self.sample_rate)
+        elapsed = self._get_current_time() - self.window.start_time()
+        if elapsed <= 0:
+            return AccumulativeCounterValue(0.0, self.sample_rate)
+        return AccumulativeCounterValue(self.window.sum() / elapsed, self.sample_rate)
+
+    def _get_sharded_value(self):
+        live, retired = self.shards.collect()
+        window_limit = self.get_current_window_start_time()
+        # shards of exited threads have no owner to trim them anymore.
+        self._retired_shards.extend(retired)
+        for shard in self._retired_shards:
+            shard.trim(window_limit)
+        self._retired_shards = [shard for shard in self._retired_shards if shard.events]
+
+        total = 0.0
+        start_time = None
+        for shard in live + self._retired_shards:
+            for t, v in list(shard.events):  # copying a deque is atomic, iterating it while appended to isn't.
+                if t < window_limit:
+                    continue
+                total += v
+                if start_time is None or t < start_time:
+                    start_time = t
+
+        if start_time is None:
+            return AccumulativeCounterValue(0.0, self.sample_rate)
+        return AccumulativeCounterValue(total / (self._get_current_time() - start_time), self.sample_rate)
+
+    def _clear(self):
+        super(FrequencyCounter, self)._clear()
+        if self.shards is not None:
+            self.shards.clear()
+            self._retired_shards = []
 
 
 class WindowCounter(TriggerMixin, BaseWindowCounter):
     """ Counts the number of end events in a sliding window """
+
     def _get_value(self):
         super(WindowCounter, self)._get_value()
-        if not self.values or len(self.values) < 1:
-            return AccumulativeCounterValue(0.0)
-        return AccumulativeCounterValue(sum(self.values, 0.0))
+        if self.window.count() < 1:
+            return AccumulativeCounterValue(0.0, self.sample_rate)
+        return AccumulativeCounterValue(self.window.sum(), self.sample_rate)
 
 
 class MaxWindowCounter(AutoDispatch, BaseWindowCounter):
     """ Counts maximum of events values in window """
+
+    def _create_window(self):
+        if self.buckets or self.delta:
+            return super(MaxWindowCounter, self)._create_window()
+        return DequeWindow(track_max=True, max_samples=self.max_samples)
+
     def _get_value(self):
         super(MaxWindowCounter, self)._get_value()
-        if not self.values:
+        val = self.window.max()
+        if val is None:
             return MaxCounterValue(None)
-        val = max(self.values)
         return MaxCounterValue(float(val))
 
 
 class MinWindowCounter(AutoDispatch, BaseWindowCounter):
     """ Counts minimum of events values in window """
+
+    def _create_window(self):
+        if self.buckets or self.delta:
+            return super(MinWindowCounter, self)._create_window()
+        return DequeWindow(track_min=True, max_samples=self.max_samples)
+
     def _get_value(self):
         self._trim_window()
-        if not self.values:
+        val = self.window.min()
+        if val is None:
             return MinCounterValue(None)
-        val = min(self.values)
         return MinCounterValue(float(val))
 
 
 class AverageTimeCounter(TimerMixin, AverageWindowCounter):
-    """ Counts the average time between start and end events
+    """ Counts the average time between start and end events. Nested events, e.g. of recursive calls, are timed
+        each from its own start. Pass exclusive=True to leave the time of nested events out.
+    """
+    pass
+
+
+class HistogramCounter(AutoDispatch, BaseSlotValueWindowCounter):
+    """ Keeps a histogram of events' values in a sliding window. Reports the 50th, 90th, 99th and 99.9th
+        percentiles along with the count, minimum and maximum of the values.
+
+        The histogram uses log-linear buckets - every power of two is divided into 2 ** precision buckets. Values
+        are estimated with a relative error of at most 2 ** -(precision + 1) . Values <= 0 are counted as 0.
+        The window is divided into time slots (see buckets parameter of BaseWindowCounter), each with its own
+        histogram.
+    """
+
+    def __init__(self, name, window_size=300.0, events=None, buckets=10, precision=7):
+        self.precision = precision
+        super(HistogramCounter, self).__init__(name, window_size=window_size, events=events, buckets=buckets)
+
+    def _create_value(self):
+        return HistogramCounterValue(precision=self.precision)
+
+
+class HistogramTimeCounter(TimerMixin, HistogramCounter):
+    """ Keeps a histogram of the time between start and end events. See HistogramCounter.
+    """
+    pass
+
+
+class QuantileSketchCounter(AutoDispatch, BaseSlotValueWindowCounter):
+    """ Estimates quantiles of events' values in a sliding window, using a DDSketch. Reports the 50th, 90th, 99th and
+        99.9th percentiles along with the count, minimum and maximum of the values.
+
+        Unlike HistogramCounter, values can be of any sign and range. Quantiles are estimated with a relative error
+        of relative_accuracy. Memory is bounded by max_bins per time slot of the window (see the buckets parameter
+        of BaseWindowCounter); when exceeded, the lowest bins are merged, losing accuracy of the lowest quantiles.
+    """
+
+    def __init__(self, name, window_size=300.0, events=None, buckets=10, relative_accuracy=0.01, max_bins=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        super(QuantileSketchCounter, self).__init__(name, window_size=window_size, events=events, buckets=buckets)
+
+    def _create_value(self):
+        return QuantileSketchCounterValue(relative_accuracy=self.relative_accuracy, max_bins=self.max_bins)
+
+
+class SummaryCounter(AutoDispatch, BaseWindowCounter):
+    """ Summarizes events' values in a sliding window: reports their count, sum, minimum, maximum, mean and
+        rate per second. All are computed from one window, which is divided into time slots (see the buckets
+        parameter of BaseWindowCounter). Pass buckets=None to keep every value.
+    """
+
+    def __init__(self, name, window_size=300.0, events=None, buckets=60, max_samples=None):
+        super(SummaryCounter, self).__init__(name, window_size=window_size, events=events, buckets=buckets,
+                                             max_samples=max_samples)
+
+    def _create_window(self):
+        if self.buckets:
+            return super(SummaryCounter, self)._create_window()
+        return DequeWindow(track_max=True, track_min=True, max_samples=self.max_samples)
+
+    def _get_value(self):
+        super(SummaryCounter, self)._get_value()
+        count = self.window.count()
+        if not count:
+            return SummaryCounterValue()
+        rate = None
+        elapsed = self._get_current_time() - self.window.start_time()
+        if elapsed > 0:
+            rate = count / elapsed
+        return SummaryCounterValue(count, self.window.sum(), self.window.min(), self.window.max(), rate)
+
+
+class SummaryTimeCounter(TimerMixin, SummaryCounter):
+    """ Summarizes the time between start and end events. See SummaryCounter.
+    """
+    pass
+
+
+class VarianceWindowCounter(AutoDispatch, BaseSlotValueWindowCounter):
+    """ Reports the count, mean, variance and standard deviation of events' values in a sliding window. Values
+        are accumulated with Welford's algorithm and merged across processes with Chan's parallel algorithm,
+        keeping the standard deviation numerically stable and exact.
+
+        The window is divided into time slots (see the buckets parameter of BaseWindowCounter), each keeping
+        only a running count, mean and m2 - constant memory. Pass buckets=None to keep every value.
+    """
+
+    def __init__(self, name, window_size=300.0, events=None, buckets=10, max_samples=None):
+        super(VarianceWindowCounter, self).__init__(name, window_size=window_size, events=events, buckets=buckets,
+                                                    max_samples=max_samples)
+
+    def _create_window(self):
+        if self.buckets:
+            return super(VarianceWindowCounter, self)._create_window()
+        return BaseWindowCounter._create_window(self)
+
+    def _create_value(self):
+        return VarianceCounterValue()
+
+    def _get_value(self):
+        if self.buckets:
+            return super(VarianceWindowCounter, self)._get_value()
+        self._trim_window()
+        v = VarianceCounterValue()
+        for value, weight in self.window.get_samples():
+            v.add(value, weight)
+        return v
+
+
+class VarianceTimeCounter(TimerMixin, VarianceWindowCounter):
+    """ Reports the count, mean, variance and standard deviation of the time between start and end events.
+        See VarianceWindowCounter.
     """
     pass
 
 
-class EventCounter(TriggerMixin, BaseCounter):
+class CardinalityCounter(AutoDispatch, BaseSlotValueWindowCounter):
+    """ Estimates the number of distinct values reported in a sliding window (e.g. unique users or cache keys),
+        using HyperLogLog. Report the distinct items as values: report_value("unique_users", user_id) .
+
+        Memory is fixed: each time slot of the window (see the buckets parameter of BaseWindowCounter) has
+        2 ** precision one byte registers. Slots are reset as the window moves on. The estimate has a standard
+        error of about 1.04 / sqrt(2 ** precision).
+    """
+
+    def __init__(self, name, window_size=300.0, events=None, buckets=5, precision=12):
+        self.precision = precision
+        super(CardinalityCounter, self).__init__(name, window_size=window_size, events=events, buckets=buckets)
+
+    def _create_value(self):
+        return CardinalityCounterValue(precision=self.precision)
+
+
+class ConcurrencyCounter(AutoDispatch, BaseCounter):
+    """ Counts operations in flight: start events increment it and end events decrement it. Reports the current
+        number, the peak during the window and the time weighted average over the window.
+
+        The window is divided into a fixed number of time slots (buckets), keeping the peak and the area under the
+        concurrency of each slot. Events take constant time and memory. Sampled operations count as the number of
+        operations they stand for.
+    """
+
+    def __init__(self, name, window_size=300.0, events=None, buckets=60):
+        self.window_size = window_size
+        self.buckets = buckets
+        self.peaks = BucketWindow(window_size, buckets)
+        self.areas = BucketWindow(window_size, buckets)
+        self._clear()
+        super(ConcurrencyCounter, self).__init__(name, events=events)
+
+    def _clear(self):
+        self.current = 0
+        self.start_time = self.last_change = self._get_current_time()
+        self.peaks.clear()
+        self.areas.clear()
+
+    def _advance(self, now):
+        """ adds the area under the current concurrency since the last change, slot by slot. """
+        slot_size = self.areas.slot_size
+        t = max(self.last_change, now - self.window_size - slot_size)  # older slots are out of the window anyway.
+        if self.current:
+            while t < now:
+                end = min((t // slot_size + 1) * slot_size, now)
+                self.areas.add(self.current * (end - t), t)
+                t = end
+        self.last_change = now
+
+    def _report_event_start(self, name, param):
+        now = self._get_event_time()
+        self._advance(now)
+        self.current += self._get_sample_weight()
+        self.peaks.add(self.current, now)
+
+    def _report_event_end(self, name, param):
+        now = self._get_event_time()
+        self._advance(now)
+        self.peaks.add(self.current, now)  # the concurrency held until now
+        self.current -= self._get_sample_weight()
+
+    def _get_value(self):
+        now = self._get_current_time()
+        self._advance(now)
+        window_limit = now - self.window_size
+        self.peaks.trim(window_limit)
+        self.areas.trim(window_limit)
+
+        peak = self.peaks.max()
+        peak = self.current if peak is None else max(peak, self.current)
+        # the areas cover whole slots: the slot now is in and the buckets - 1 slots before it. Older slots were
+        # overwritten, or are about to be.
+        slot_size = self.areas.slot_size
+        first_id = int(now // slot_size) - self.buckets + 1
+        area = sum([s.sum for s in self.areas.get_slots() if s.id >= first_id], 0.0)
+        start = max(first_id * slot_size, self.start_time)
+        average = area / (now - start) if now > start else None
+        return ConcurrencyCounterValue(self.current, peak, average)
+
+
+
+class EWMARateCounter(TriggerMixin, BaseEWMACounter):
+    """ Reports the rate per second of occurrences as exponentially weighted moving averages over 1, 5 and 15
+        minutes (configurable, see BaseEWMACounter). Like FrequencyCounter, occurrences can be reported via a value
+        event (X occurrences has happened now) or an end event. Uses constant memory.
+    """
+
+    def _get_value(self):
+        self._tick()
+        rates = self._get_averages(self.average_sums)
+        for horizon, s in rates.iteritems():
+            if s is not None:
+                rates[horizon] = s / self.tick_interval
+        return EWMARateCounterValue(rates)
+
+
+class EWMAAverageCounter(AutoDispatch, BaseEWMACounter):
+    """ Reports exponentially weighted moving averages of values over 1, 5 and 15 minutes (configurable, see
+        BaseEWMACounter). Uses constant memory.
+    """
+
+    def _get_value(self):
+        self._tick()
+        return EWMAAverageCounterValue(self._get_averages(self.average_sums),
+                                       self._get_averages(self.average_counts))
+
+
+class EventCounter(ShardedMixin, TriggerMixin, BaseCounter):
     """ Counts the number of times an end event has fired.
+
+        Pass sharded=True to count in per thread shards, without locking. Pass delta=True to report the number of
+        events since the previous report.
     """
 
-    def __init__(self, name, events=None):
+    def __init__(self, name, events=None, sharded=False, delta=False):
         self.value = None
-        super(EventCounter, self).__init__(name, events=events)
+        super(EventCounter, self).__init__(name, events=events, sharded=sharded, delta=delta)
+
+    def _create_shard(self):
+        return _AccumulatorShard()
 
     def _get_value(self):
-        return AccumulativeCounterValue(self.value)
+        if self.shards is not None:
+            return _get_accumulated_shards_value(self)
+        return AccumulativeCounterValue(self.value, self.sample_rate)
 
     def _report_event_value(self, name, value):
+        sampled = EVENT_CONTEXT.weight != 1
+        if sampled or self.sample_rate is not None:
+            value = self._scale_sampled(value)
 
-        if self.value:
+        if self.shards is not None:
+            self.shards.get().add(value, sampled)
+        elif self.value:
             self.value += value
+        elif sampled:
+            self.value = value
         else:
             self.value = long(value)
 
     def _clear(self):
         self.value = 0L
+        if self.shards is not None:
+            self.shards.clear()
 
 
 class ValueAccumulator(AutoDispatch, BaseCounter):
     """ Captures all named values it gets and accumulates them.
         Also allows rethrowing them, prefixed with their name."""
 
-    def __init__(self, name, events=None):
+    def __init__(self, name, events=None, delta=False):
         self.accumulated_values = dict()
         # forces the object not to accumulate values. Used when the object itself is raising events
         self._ignore_values = False
 
-        super(ValueAccumulator, self).__init__(name, events=events)
+        super(ValueAccumulator, self).__init__(name, events=events, delta=delta)
 
     def _report_event_value(self, name, value):
         if self._ignore_values:
@@ -152,3 +566,142 @@ class ValueAccumulator(AutoDispatch, BaseCounter):
 
             if clear:
                 self._clear()
+
+
+class TopKCounter(AutoDispatch, BaseCounter):
+    """ Finds the k most frequent values reported (e.g. the hottest endpoints or tenants). Report the items as
+        values, like with CardinalityCounter: report_value("hot_endpoints", "/api/x") .
+
+        Memory doesn't grow with the number of distinct items: only k items are kept, using the Space-Saving
+        algorithm. Reported counts may over estimate an item by at most its reported error.
+    """
+
+    def __init__(self, name, events=None, k=10):
+        self.k = k
+        self.top = TopKCounterValue(k)
+        super(TopKCounter, self).__init__(name, events=events)
+
+    def _report_event_value(self, name, value):
+        self.top.add(value, self._get_sample_weight())
+
+    def _get_value(self):
+        v = TopKCounterValue(self.k)
+        v.items = dict(self.top.items)
+        return v
+
+    def _clear(self):
+        self.top = TopKCounterValue(self.k)
+
+
+class _FamilyChild(object):
+    """ a child of a CounterFamily. Reports events directly to the child counter, with handlers resolved once.
+        Like an EventHandle, events are ignored while the family's event name is disabled.
+    """
+
+    def __init__(self, family, labels, counter):
+        self.labels = labels
+        self.counter = counter
+        self.handle = event_handle(family.name)  # for its enabled flag
+        for property in ("start", "end", "value"):
+            handler = counter.get_event_handler(family.name, property)
+            setattr(self, "_" + property, handler if handler is not None else _ignore_event)
+
+    def start(self):
+        """ reports the start of the event """
+        if self.handle.enabled:
+            self._start(None)
+
+    def end(self):
+        """ reports the end of the event """
+        if self.handle.enabled:
+            self._end(None)
+
+    def value(self, value):
+        """ reports a value """
+        if self.handle.enabled:
+            self._value(value)
+
+
+def _ignore_event(param):
+    pass
+
+
+class CounterFamily(BaseCounter):
+    """ A family of counters of the same type, distinguished by labels. Use labels() to get the child counter of
+        a set of labels and report events through it:
+
+            requests = CounterFamily("requests", FrequencyCounter)
+            register_counter(requests)
+            requests.labels(route="/api", code=200).end()
+
+        Children are created by calling counter_factory with the family name and are cached, so labels() doesn't
+        go through the counter registry. The family reports the labels and value of every child (see
+        FamilyCounterValue), rather than a counter per formatted name.
+
+        max_children - an optional cap on the number of children. When reached, the least recently used child is
+            dropped to make room for a new one, losing its data.
+    """
+
+    def __init__(self, name, counter_factory, max_children=None):
+        self.counter_factory = counter_factory
+        self.max_children = max_children
+        self.children = OrderedDict()  # least recently used first, when max_children is set
+        super(CounterFamily, self).__init__(name, events=[])
+
+    def labels(self, **labels):
+        """ returns the child counter of the given labels, creating it if needed. The child has start(), end() and
+            value(v) methods to report events.
+        """
+        key = tuple(sorted(labels.iteritems()))
+        children = self.children
+        if self.max_children:
+            # keeping the children in order of use takes the lock on every call.
+            with self.lock:
+                child = children.pop(key, None)
+                if child is None:
+                    if len(children) >= self.max_children:
+                        children.popitem(last=False)
+                    child = self._create_child(key)
+                children[key] = child
+            return child
+
+        child = children.get(key)
+        if child is None:
+            with self.lock:
+                child = children.get(key)
+                if child is None:
+                    child = self._create_child(key)
+                    children[key] = child
+        return child
+
+    def _create_child(self, key):
+        return _FamilyChild(self, key, self.counter_factory(self.name))
+
+    def _report_event(self, name, property, param):
+        pass
+
+    def collect_value(self):
+        """ collects the values of the children for a report (see BaseCounter.collect_value), clearing children in
+            delta mode.
+        """
+        with self.lock:
+            return self._get_children_value(collect=True)
+
+    def _get_value(self):
+        return self._get_children_value()
+
+    def _get_children_value(self, collect=False):
+        children = dict()
+        estimated = False
+        for key, child in self.children.iteritems():
+            v = child.counter.collect_value() if collect else child.counter.get_value()
+            estimated = estimated or getattr(v, "estimated", False)
+            children[key] = v
+        value = FamilyCounterValue(children)
+        if estimated:
+            value.estimated = True
+        return value
+
+    def _clear(self):
+        for child in self.children.itervalues():
+            child.counter.clear()
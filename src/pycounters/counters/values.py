@@ -1,42 +1,139 @@
-from pycounters.base import CounterValueBase
+import hashlib
+import heapq
+import math
+import struct
+from pycounters.base import CounterValueBase, CompositeCounterValue
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _group_offsets(groups):
+    """ returns the index of the first value of every group, once groups are concatenated """
+    offsets = []
+    offset = 0
+    for values in groups:
+        offsets.append(offset)
+        offset += len(values)
+    return offsets
 
 
 class AccumulativeCounterValue(CounterValueBase):
     """ Counter values that are added upon merges
+
+        sample_rate - the fraction of events the value was computed from, when events were sampled. The value is
+            already scaled up. Upon merges, the rate of the merged value is weighted by the values.
     """
 
+    sample_rate = None
+
+    def __init__(self, value, sample_rate=None):
+        self.value = value
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+
     def merge_with(self, other_counter_value):
         """ updates this CounterValue with information of another. Used for multiprocess reporting
         """
+        if self.sample_rate is not None or getattr(other_counter_value, "sample_rate", None) is not None:
+            self.sample_rate = self._merge_sample_rates(self, other_counter_value)
         if self.value:
             if other_counter_value.value:
                 self.value += other_counter_value.value
         else:
             self.value = other_counter_value.value
 
+    @staticmethod
+    def _merge_sample_rates(a, b):
+        rate_a = 1.0 if a.sample_rate is None else a.sample_rate
+        rate_b = getattr(b, "sample_rate", None)
+        if rate_b is None:
+            rate_b = 1.0
+        total = (a.value or 0) + (b.value or 0)
+        if not total:
+            return min(rate_a, rate_b)
+        # the number of events actually seen, over the estimated number of events.
+        return ((a.value or 0) * rate_a + (b.value or 0) * rate_b) / total
+
+    @classmethod
+    def merge_groups(cls, groups):
+        # Same logic as merge_with, without the method calls. Not using numpy to keep (long) integers exact.
+        ret = []
+        for values in groups:
+            merged = values[0]
+            s = merged.value
+            sampled = merged.sample_rate is not None
+            for v in values[1:]:
+                o = v.value
+                if v.sample_rate is not None:
+                    sampled = True
+                if s:
+                    if o:
+                        s += o
+                else:
+                    s = o
+            if sampled:
+                # rare. Merge again, one by one.
+                merged = cls(merged.value, merged.sample_rate)
+                for v in values[1:]:
+                    merged.merge_with(v)
+            else:
+                merged.value = s
+            ret.append(merged)
+        return ret
+
 
 class AverageCounterValue(CounterValueBase):
-    """ Counter values that are averaged upon merges
+    """ Counter values that are averaged upon merges. Only the weighted sum and the count of the averaged
+        elements are kept, so merging doesn't grow the value.
     """
 
     @property
     def value(self):
-        if not self._values:
+        if not self._count:
             return None
-        sum_of_counts = sum([c for v, c in self._values], 0)
-        return sum([v * c for v, c in self._values], 0.0) / sum_of_counts
+        return self._sum / self._count
 
     def __init__(self, value, agg_count):
         """
             value - the average counter to store
             agg_count - the number of elements that was averaged in value. Important for proper merging.
         """
-        self._values = [(value, agg_count)] if value is not None else []
+        if value is None:
+            self._sum = 0.0
+            self._count = 0
+        else:
+            self._sum = float(value) * agg_count
+            self._count = agg_count
 
     def merge_with(self, other_counter_value):
         """ updates this CounterValue with information of another. Used for multiprocess reporting
         """
-        self._values.extend(other_counter_value._values)
+        self._sum += other_counter_value._sum
+        self._count += other_counter_value._count
+
+    @classmethod
+    def merge_groups(cls, groups):
+        if numpy is not None:
+            offsets = _group_offsets(groups)
+            sums = numpy.add.reduceat(numpy.array([v._sum for group in groups for v in group], dtype=float),
+                                      offsets)
+            counts = numpy.add.reduceat(numpy.array([v._count for group in groups for v in group]), offsets)
+            sums = sums.tolist()
+            counts = counts.tolist()
+        else:
+            sums = [sum([v._sum for v in values], 0.0) for values in groups]
+            counts = [sum([v._count for v in values], 0) for values in groups]
+
+        ret = []
+        for values, s, c in zip(groups, sums, counts):
+            merged = values[0]
+            merged._sum = s
+            merged._count = c
+            ret.append(merged)
+        return ret
 
 
 class MaxCounterValue(CounterValueBase):
@@ -52,6 +149,26 @@ class MaxCounterValue(CounterValueBase):
         if other_counter_value.value is not None and self.value < other_counter_value.value:
             self.value = other_counter_value.value
 
+    @classmethod
+    def merge_groups(cls, groups):
+        if numpy is not None:
+            offsets = _group_offsets(groups)
+            flat = numpy.array([v.value for group in groups for v in group], dtype=float)  # None becomes nan
+            results = numpy.fmax.reduceat(flat, offsets).tolist()
+            results = [None if r != r else r for r in results]  # nan means all values were None
+        else:
+            results = []
+            for values in groups:
+                not_none = [v.value for v in values if v.value is not None]
+                results.append(max(not_none) if not_none else None)
+
+        ret = []
+        for values, r in zip(groups, results):
+            merged = values[0]
+            merged.value = r
+            ret.append(merged)
+        return ret
+
 
 class MinCounterValue(CounterValueBase):
     """ Counter values that are merged by selecting the minimal value. None values are ignored.
@@ -65,3 +182,543 @@ class MinCounterValue(CounterValueBase):
             return
         if other_counter_value.value is not None and self.value > other_counter_value.value:
             self.value = other_counter_value.value
+
+    @classmethod
+    def merge_groups(cls, groups):
+        if numpy is not None:
+            offsets = _group_offsets(groups)
+            flat = numpy.array([v.value for group in groups for v in group], dtype=float)  # None becomes nan
+            results = numpy.fmin.reduceat(flat, offsets).tolist()
+            results = [None if r != r else r for r in results]  # nan means all values were None
+        else:
+            results = []
+            for values in groups:
+                not_none = [v.value for v in values if v.value is not None]
+                results.append(min(not_none) if not_none else None)
+
+        ret = []
+        for values, r in zip(groups, results):
+            merged = values[0]
+            merged.value = r
+            ret.append(merged)
+        return ret
+
+
+def log_linear_bucket(value, precision):
+    """ returns the index of the log-linear histogram bucket of value. Every power of two is divided into
+        2 ** precision equally sized buckets. Values <= 0 are all put in bucket None.
+    """
+    if value <= 0:
+        return None
+    m, e = math.frexp(value)  # value = m * 2 ** e, 0.5 <= m < 1
+    sub_buckets = 1 << precision
+    return e * sub_buckets + int((2 * m - 1) * sub_buckets)
+
+
+def log_linear_bucket_value(index, precision):
+    """ returns the middle of a log-linear histogram bucket """
+    if index is None:
+        return 0.0
+    sub_buckets = 1 << precision
+    e, sub_bucket = divmod(index, sub_buckets)
+    return math.ldexp(1 + (sub_bucket + 0.5) / sub_buckets, e - 1)
+
+
+class HistogramCounterValue(CompositeCounterValue):
+    """ Counter values holding a log-linear histogram. Merged by adding up bucket counts, so that percentiles
+        are correct over all merged values. Values are reported with a relative error of at most
+        2 ** -(precision + 1) .
+    """
+
+    percentiles = [("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999)]
+
+    def __init__(self, precision=7):
+        self.precision = precision
+        self.buckets = dict()
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    @property
+    def value(self):
+        ret = dict(count=self.count, min=self.min, max=self.max)
+        for name, p in self.percentiles:
+            ret[name] = self.get_percentile(p)
+        return ret
+
+    def add(self, value, count=1):
+        """ adds count occurrences of value to the histogram """
+        b = log_linear_bucket(value, self.precision)
+        self.buckets[b] = self.buckets.get(b, 0) + count
+        if not self.count:
+            self.min = value
+            self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.count += count
+
+    def get_percentile(self, p):
+        """ returns an estimate of the p (0 <= p <= 1) percentile. None if empty. """
+        if not self.count:
+            return None
+        rank = max(int(math.ceil(p * self.count)), 1)
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= rank:
+                # the bucket middle can be out of the range of actual values.
+                return min(max(log_linear_bucket_value(b, self.precision), self.min), self.max)
+
+    def merge_with(self, other_counter_value):
+        """ updates this CounterValue with information of another. Used for multiprocess reporting
+        """
+        if other_counter_value.precision != self.precision:
+            raise Exception("Can't merge histograms of different precisions (%s and %s)" %
+                            (self.precision, other_counter_value.precision))
+        if not other_counter_value.count:
+            return
+        for b, c in other_counter_value.buckets.iteritems():
+            self.buckets[b] = self.buckets.get(b, 0) + c
+        if not self.count:
+            self.min = other_counter_value.min
+            self.max = other_counter_value.max
+        else:
+            self.min = min(self.min, other_counter_value.min)
+            self.max = max(self.max, other_counter_value.max)
+        self.count += other_counter_value.count
+
+
+class QuantileSketchCounterValue(CompositeCounterValue):
+    """ Counter values holding a DDSketch of values. Quantiles are estimated with a relative error of
+        relative_accuracy. Merged by adding up bins, so quantiles are correct over all merged values.
+        Each of the positive and negative bin stores is limited to max_bins; beyond that the bins of the values
+        closest to zero are merged.
+    """
+
+    percentiles = HistogramCounterValue.percentiles
+
+    # values closer to zero than this are counted as zero.
+    min_indexable_value = 1e-300
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive_bins = dict()
+        self.negative_bins = dict()  # bins of the absolute values
+        self.zero_count = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    @property
+    def value(self):
+        ret = dict(count=self.count, min=self.min, max=self.max)
+        for name, p in self.percentiles:
+            ret[name] = self.get_percentile(p)
+        return ret
+
+    def _add_to_bins(self, bins, index, count):
+        if index in bins:
+            bins[index] += count
+            return
+        bins[index] = count
+        if len(bins) > self.max_bins:
+            lowest, next_lowest = heapq.nsmallest(2, bins)
+            bins[next_lowest] += bins.pop(lowest)
+
+    def add(self, value, count=1):
+        """ adds count occurrences of value to the sketch """
+        if value > self.min_indexable_value:
+            self._add_to_bins(self.positive_bins, int(math.ceil(math.log(value) / self.log_gamma)), count)
+        elif value < -self.min_indexable_value:
+            self._add_to_bins(self.negative_bins, int(math.ceil(math.log(-value) / self.log_gamma)), count)
+        else:
+            self.zero_count += count
+
+        if not self.count:
+            self.min = value
+            self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.count += count
+
+    def _bin_value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def get_percentile(self, p):
+        """ returns an estimate of the p (0 <= p <= 1) percentile. None if empty. """
+        if not self.count:
+            return None
+        rank = p * (self.count - 1)
+        seen = 0
+        # from the most negative value up
+        for index in sorted(self.negative_bins, reverse=True):
+            seen += self.negative_bins[index]
+            if seen > rank:
+                return max(-self._bin_value(index), self.min)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive_bins):
+            seen += self.positive_bins[index]
+            if seen > rank:
+                return min(self._bin_value(index), self.max)
+        return self.max
+
+    def merge_with(self, other_counter_value):
+        """ updates this CounterValue with information of another. Used for multiprocess reporting
+        """
+        if other_counter_value.relative_accuracy != self.relative_accuracy:
+            raise Exception("Can't merge sketches of different relative accuracies (%s and %s)" %
+                            (self.relative_accuracy, other_counter_value.relative_accuracy))
+        if not other_counter_value.count:
+            return
+        for index, c in other_counter_value.positive_bins.iteritems():
+            self._add_to_bins(self.positive_bins, index, c)
+        for index, c in other_counter_value.negative_bins.iteritems():
+            self._add_to_bins(self.negative_bins, index, c)
+        self.zero_count += other_counter_value.zero_count
+        if not self.count:
+            self.min = other_counter_value.min
+            self.max = other_counter_value.max
+        else:
+            self.min = min(self.min, other_counter_value.min)
+            self.max = max(self.max, other_counter_value.max)
+        self.count += other_counter_value.count
+
+
+class EWMARateCounterValue(CompositeCounterValue):
+    """ Counter values holding rates per second of several horizons (see BaseEWMACounter). Rates of the same
+        horizon are added upon merges. None values are ignored.
+    """
+
+    def __init__(self, rates):
+        """
+            rates - a dictionary of horizon name to rate per second.
+        """
+        self.rates = rates
+
+    @property
+    def value(self):
+        return dict(self.rates)
+
+    def merge_with(self, other_counter_value):
+        """ updates this CounterValue with information of another. Used for multiprocess reporting
+        """
+        for horizon, rate in other_counter_value.rates.iteritems():
+            if rate is None:
+                continue
+            current = self.rates.get(horizon)
+            self.rates[horizon] = rate if current is None else current + rate
+
+
+class EWMAAverageCounterValue(CompositeCounterValue):
+    """ Counter values holding exponentially weighted averages of several horizons (see BaseEWMACounter). Merged by
+        adding up the weighted sums and counts behind each average.
+    """
+
+    def __init__(self, sums, counts):
+        """
+            sums, counts - dictionaries of horizon name to the weighted sum and count of values
+        """
+        self.sums = sums
+        self.counts = counts
+
+    @property
+    def value(self):
+        ret = {}
+        for horizon, s in self.sums.iteritems():
+            count = self.counts.get(horizon)
+            ret[horizon] = s / count if count else None
+        return ret
+
+    def merge_with(self, other_counter_value):
+        """ updates this CounterValue with information of another. Used for multiprocess reporting
+        """
+        for horizon, s in other_counter_value.sums.iteritems():
+            count = other_counter_value.counts.get(horizon)
+            if s is None or count is None:
+                continue
+            if self.sums.get(horizon) is None:
+                self.sums[horizon] = s
+                self.counts[horizon] = count
+            else:
+                self.sums[horizon] += s
+                self.counts[horizon] += count
+
+
+class SummaryCounterValue(CompositeCounterValue):
+    """ Counter values summarizing values with their count, sum, minimum, maximum, mean and rate per second.
+        Merged by adding counts, sums and rates and selecting the extreme minimum and maximum.
+    """
+
+    def __init__(self, count=0, sum=0.0, min=None, max=None, rate=None):
+        self.count = count
+        self.sum = sum
+        self.min = min
+        self.max = max
+        self.rate = rate
+
+    @property
+    def value(self):
+        return dict(count=self.count, sum=self.sum, min=self.min, max=self.max,
+                    mean=self.sum / self.count if self.count else None, rate=self.rate)
+
+    def merge_with(self, other_counter_value):
+        """ updates this CounterValue with information of another. Used for multiprocess reporting
+        """
+        if not other_counter_value.count:
+            return
+        if not self.count:
+            self.min = other_counter_value.min
+            self.max = other_counter_value.max
+        else:
+            self.min = min(self.min, other_counter_value.min)
+            self.max = max(self.max, other_counter_value.max)
+        self.count += other_counter_value.count
+        self.sum += other_counter_value.sum
+        if other_counter_value.rate is not None:
+            self.rate = other_counter_value.rate if self.rate is None else self.rate + other_counter_value.rate
+
+
+class VarianceCounterValue(CompositeCounterValue):
+    """ Counter values reporting the count, mean, variance and standard deviation of values. Values are added with
+        Welford's algorithm, keeping a running mean and sum of squared deviations (m2). Merged with Chan's parallel
+        algorithm, so the merged variance is the variance of all the values.
+        The variance is the population variance (m2 / count).
+    """
+
+    def __init__(self, count=0, mean=None, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    @property
+    def value(self):
+        if not self.count:
+            return dict(count=0, mean=None, variance=None, stddev=None)
+        variance = self.m2 / self.count
+        return dict(count=self.count, mean=self.mean, variance=variance, stddev=math.sqrt(variance))
+
+    def add(self, value, count=1):
+        """ adds count occurrences of value """
+        if not self.count:
+            self.count = count
+            self.mean = float(value)
+            self.m2 = 0.0
+            return
+        self.count += count
+        delta = value - self.mean
+        self.mean += delta * count / self.count
+        self.m2 += delta * (value - self.mean) * count
+
+    def merge_with(self, other_counter_value):
+        """ updates this CounterValue with information of another. Used for multiprocess reporting
+        """
+        if not other_counter_value.count:
+            return
+        if not self.count:
+            self.count = other_counter_value.count
+            self.mean = other_counter_value.mean
+            self.m2 = other_counter_value.m2
+            return
+        count = self.count + other_counter_value.count
+        delta = other_counter_value.mean - self.mean
+        self.mean += delta * other_counter_value.count / count
+        self.m2 += other_counter_value.m2 + delta * delta * self.count * other_counter_value.count / count
+        self.count = count
+
+
+class CardinalityCounterValue(CounterValueBase):
+    """ Counter values estimating the number of distinct values, using HyperLogLog. Holds 2 ** precision one byte
+        registers; the estimate has a standard error of about 1.04 / sqrt(2 ** precision). Merged by taking the
+        maximum of every register, which gives the estimate of the union of the merged values.
+    """
+
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be between 4 and 16, got %s" % (precision,))
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    @property
+    def value(self):
+        m = len(self.registers)
+        if m == 16:
+            alpha = 0.673
+        elif m == 32:
+            alpha = 0.697
+        elif m == 64:
+            alpha = 0.709
+        else:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum([2.0 ** -r for r in self.registers])
+        if estimate <= 2.5 * m:
+            zeros = self.registers.count("\0")
+            if zeros:
+                estimate = m * math.log(float(m) / zeros)  # linear counting is more accurate for small sets.
+        return int(round(estimate))
+
+    def add(self, value, count=1):
+        """ adds a value to the set. Values are identified by their string representation (unicode as UTF-8).
+            count doesn't matter - a value is counted once.
+        """
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        else:
+            value = str(value)
+        h = struct.unpack(">Q", hashlib.sha1(value).digest()[:8])[0]
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge_with(self, other_counter_value):
+        """ updates this CounterValue with information of another. Used for multiprocess reporting
+        """
+        if other_counter_value.precision != self.precision:
+            raise Exception("Can't merge cardinality sketches of different precisions (%s and %s)" %
+                            (self.precision, other_counter_value.precision))
+        self.registers = bytearray(map(max, self.registers, other_counter_value.registers))
+
+
+class TopKCounterValue(CounterValueBase):
+    """ Counter values holding a Space-Saving summary of the k most frequent items. The value is a list of
+        (item, count, error) tuples, most frequent first. An item's true count is between count - error and count.
+        Merged as a mergeable summary: items missing from a full summary are assumed to have its minimal count,
+        keeping the error bounds valid over all merged values.
+    """
+
+    def __init__(self, k=10):
+        self.k = k
+        self.items = dict()  # item -> (count, error)
+
+    @property
+    def value(self):
+        return [(item, count, error) for item, (count, error) in self._get_top_items()]
+
+    def _get_top_items(self):
+        return sorted(self.items.iteritems(), key=lambda i: i[1][0], reverse=True)[:self.k]
+
+    def _get_min_count(self):
+        """ the count an item not in the summary may have. """
+        if len(self.items) < self.k:
+            return 0
+        return min([count for count, error in self.items.itervalues()])
+
+    def add(self, item, count=1):
+        """ adds count occurrences of item """
+        items = self.items
+        current = items.get(item)
+        if current is not None:
+            items[item] = (current[0] + count, current[1])
+        elif len(items) < self.k:
+            items[item] = (count, 0)
+        else:
+            # replace the least frequent item. The new item may have occurred up to min_count times before.
+            min_item, (min_count, min_error) = min(items.iteritems(), key=lambda i: i[1][0])
+            del items[min_item]
+            items[item] = (min_count + count, min_count)
+
+    def merge_with(self, other_counter_value):
+        """ updates this CounterValue with information of another. Used for multiprocess reporting
+        """
+        self_min = self._get_min_count()
+        other_min = other_counter_value._get_min_count()
+        merged = dict()
+        for item in set(self.items).union(other_counter_value.items):
+            count, error = self.items.get(item, (self_min, self_min))
+            other_count, other_error = other_counter_value.items.get(item, (other_min, other_min))
+            merged[item] = (count + other_count, error + other_error)
+        self.k = max(self.k, other_counter_value.k)
+        self.items = merged
+        self.items = dict(self._get_top_items())
+
+
+class ConcurrencyCounterValue(CompositeCounterValue):
+    """ Counter values reporting the current, peak and time weighted average number of operations in flight.
+        Merged by adding up each of them, giving the totals over all processes (the merged peak is an upper bound,
+        as the processes' peaks may not coincide).
+    """
+
+    def __init__(self, current=0, peak=0, average=None):
+        self.current = current
+        self.peak = peak
+        self.average = average
+
+    @property
+    def value(self):
+        return dict(current=self.current, peak=self.peak, average=self.average)
+
+    def merge_with(self, other_counter_value):
+        """ updates this CounterValue with information of another. Used for multiprocess reporting
+        """
+        self.current += other_counter_value.current
+        self.peak += other_counter_value.peak
+        if other_counter_value.average is not None:
+            self.average = other_counter_value.average if self.average is None else \
+                self.average + other_counter_value.average
+
+
+class MultiAverageCounterValue(CompositeCounterValue):
+    """ Counter values holding an average per horizon (see MultiAverageWindowCounter). Merged by merging the
+        averages of each horizon.
+    """
+
+    def __init__(self, averages):
+        """
+            averages - a dictionary of horizon name to AverageCounterValue
+        """
+        self.averages = averages
+
+    @property
+    def value(self):
+        return dict((horizon, v.value) for horizon, v in self.averages.iteritems())
+
+    def merge_with(self, other_counter_value):
+        """ updates this CounterValue with information of another. Used for multiprocess reporting
+        """
+        for horizon, v in other_counter_value.averages.iteritems():
+            current = self.averages.get(horizon)
+            if current is None:
+                self.averages[horizon] = AverageCounterValue(v.value, v._count)
+            else:
+                current.merge_with(v)
+
+
+class FamilyCounterValue(CounterValueBase):
+    """ Counter values of a counter family (see CounterFamily). The value is a list of dictionaries with the
+        labels of a child counter and its value: [{"labels": {"route": "/api"}, "value": 3}, ...] .
+        Merged by merging the values of children with the same labels.
+    """
+
+    def __init__(self, children=None):
+        """
+            children - a dictionary of label keys (sorted tuples of label name and value pairs) to counter values.
+        """
+        self.children = children if children is not None else dict()
+
+    @property
+    def value(self):
+        ret = []
+        for labels in sorted(self.children):
+            v = self.children[labels]
+            ret.append(dict(labels=dict(labels), value=v.value if hasattr(v, "value") else v))
+        return ret
+
+    def merge_with(self, other_counter_value):
+        """ updates this CounterValue with information of another. Used for multiprocess reporting
+        """
+        for labels, v in other_counter_value.children.iteritems():
+            current = self.children.get(labels)
+            if current is None:
+                self.children[labels] = v
+            elif v is not None:
+                current.merge_with(v)
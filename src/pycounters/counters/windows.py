@@ -0,0 +1,324 @@
+""" storage strategies for the values of sliding window counters """
+import random
+from collections import deque
+
+
+class CompensatedSum(object):
+    """ a running sum using Neumaier's compensated summation, so that adding and removing values for a long time
+        doesn't accumulate rounding errors.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sum = 0.0
+        self.compensation = 0.0
+
+    def add(self, value):
+        s = self.sum
+        t = s + value
+        if abs(s) >= abs(value):
+            self.compensation += (s - t) + value
+        else:
+            self.compensation += (value - t) + s
+        self.sum = t
+
+    @property
+    def value(self):
+        return self.sum + self.compensation
+
+
+class DequeWindow(object):
+    """ keeps every value reported during the window, with its time. Exact but memory grows with event rate.
+        The sum of the window is kept up to date as values are added and trimmed.
+
+        track_max, track_min - keep a monotonic deque of window values, making max() / min() O(1) instead of
+            scanning the window. Insertion and trimming stay amortized O(1).
+        max_samples - caps the number of values kept. When reached, half of the values are dropped and from then on
+            values are sampled: each is kept with a probability of 1 / sample_step and stands for sample_step
+            values. count() and sum() are scaled accordingly and estimated() returns True while sampled values are
+            in the window. Sampling becomes denser again as the window drains.
+
+        Values of sampled events (see EventHandle.sample_rate) are added with the number of values they stand for
+        as their weight, which is kept the same way.
+    """
+
+    def __init__(self, track_max=False, track_min=False, max_samples=None):
+        self.values = deque()
+        self.times = deque()
+        self._sum = CompensatedSum()
+        # values are numbered in order of arrival. Monotonic deques hold (number, value) tuples.
+        self._added = 0
+        self._removed = 0
+        self._max_candidates = deque() if track_max else None
+        self._min_candidates = deque() if track_min else None
+        self.max_samples = max_samples
+        self.weights = None  # the number of values each sample stands for. None while every weight is 1.
+        if max_samples is not None:
+            self._start_weighting()
+            self.sample_step = 1
+
+    def _start_weighting(self):
+        self.weights = deque([1] * len(self.values))
+        self._count = len(self.values)
+        self._sampled = 0  # number of samples with weight > 1
+
+    def add(self, value, time, weight=1):
+        if self.max_samples is None:
+            if weight != 1 and self.weights is None:
+                self._start_weighting()
+            self._append(value, time, weight)
+            return
+
+        if self.sample_step > 1:
+            if len(self.values) < self.max_samples // 4:
+                self.sample_step //= 2
+            if random.random() * self.sample_step >= 1:
+                return
+        self._append(value, time, self.sample_step * weight)
+        if len(self.values) >= self.max_samples:
+            self._thin()
+
+    def _append(self, value, time, weight=1):
+        self.values.append(value)
+        self.times.append(time)
+        if self.weights is None:
+            self._sum.add(value)
+        else:
+            self._sum.add(value * weight)
+            self.weights.append(weight)
+            self._count += weight
+            if weight > 1:
+                self._sampled += 1
+        if self._max_candidates is not None:
+            candidates = self._max_candidates
+            while candidates and candidates[-1][1] <= value:
+                candidates.pop()
+            candidates.append((self._added, value))
+        if self._min_candidates is not None:
+            candidates = self._min_candidates
+            while candidates and candidates[-1][1] >= value:
+                candidates.pop()
+            candidates.append((self._added, value))
+        self._added += 1
+
+    def _thin(self):
+        """ keeps half of the samples at random, doubling their weight, and halves the sampling probability of new
+            values.
+        """
+        samples = zip(self.values, self.times, self.weights)
+        self.clear()
+        for value, time, weight in samples:
+            if random.random() < 0.5:
+                self._append(value, time, weight * 2)
+        self.sample_step *= 2
+
+    def trim(self, window_limit):
+        """ drops values reported before window_limit """
+        while self.times and self.times[0] < window_limit:
+            self.times.popleft()
+            value = self.values.popleft()
+            if self.weights is None:
+                self._sum.add(-value)
+            else:
+                weight = self.weights.popleft()
+                self._sum.add(-value * weight)
+                self._count -= weight
+                if weight > 1:
+                    self._sampled -= 1
+            self._removed += 1
+        if not self.values:
+            self._sum.reset()  # start over with no accumulated error.
+
+        for candidates in (self._max_candidates, self._min_candidates):
+            if candidates is not None:
+                while candidates and candidates[0][0] < self._removed:
+                    candidates.popleft()
+
+    def clear(self):
+        self.values.clear()
+        self.times.clear()
+        self._sum.reset()
+        self._removed = self._added
+        for candidates in (self._max_candidates, self._min_candidates):
+            if candidates is not None:
+                candidates.clear()
+        if self.weights is not None:
+            self.weights.clear()
+            self._count = 0
+            self._sampled = 0
+
+    def count(self):
+        if self.weights is not None:
+            return self._count
+        return len(self.values)
+
+    def sum(self):
+        return self._sum.value
+
+    def max(self):
+        if self._max_candidates is not None:
+            return self._max_candidates[0][1] if self._max_candidates else None
+        return max(self.values) if self.values else None
+
+    def min(self):
+        if self._min_candidates is not None:
+            return self._min_candidates[0][1] if self._min_candidates else None
+        return min(self.values) if self.values else None
+
+    def start_time(self):
+        """ time of the oldest value in the window. None if empty. """
+        return self.times[0] if self.times else None
+
+    def get_samples(self):
+        """ returns a list of (value, weight) tuples of the values in the window """
+        if self.weights is None:
+            return [(value, 1) for value in self.values]
+        return zip(self.values, self.weights)
+
+    def estimated(self):
+        """ True if the window holds sampled values """
+        return self.weights is not None and self._sampled > 0
+
+
+class WindowSlot(object):
+    """ aggregates the values reported in one time slot of a BucketWindow """
+
+    def __init__(self):
+        self.reset(None)
+
+    def reset(self, id):
+        self.id = id
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.start_time = None
+
+    def add(self, value, time, weight=1):
+        if not self.count:
+            self.start_time = time
+            self.min = value
+            self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        if weight != 1:
+            self.count += weight
+            self.sum += value * weight
+        else:
+            self.count += 1
+            self.sum += value
+
+
+class BucketWindow(object):
+    """ divides the window into a fixed number of time slots, aggregating the values of each slot. Uses constant
+        memory and time per event. Values leave the window one slot at a time: the oldest slot is reused for the
+        newest, so the window effectively spans between window_size minus one slot and window_size. Values older
+        than the slot they map to (e.g. of events dispatched late) are out of the window and dropped.
+
+        slot_class - the class aggregating each slot. See WindowSlot for the expected interface.
+    """
+
+    def __init__(self, window_size, buckets, slot_class=WindowSlot):
+        self.slot_size = float(window_size) / buckets
+        self.slots = [slot_class() for _ in range(buckets)]
+        self.window_limit = None
+
+    def add(self, value, time, weight=1):
+        slot_id = int(time // self.slot_size)
+        slot = self.slots[slot_id % len(self.slots)]
+        if slot.id != slot_id:
+            if slot.id is not None and slot.id > slot_id:
+                return  # the slot was reused for newer values
+            slot.reset(slot_id)
+        if weight != 1:
+            slot.add(value, time, weight)
+        else:
+            slot.add(value, time)
+
+    def trim(self, window_limit):
+        """ excludes slots which ended before window_limit. """
+        self.window_limit = window_limit
+
+    def clear(self):
+        for slot in self.slots:
+            slot.reset(None)
+
+    def get_slots(self, window_limit=None):
+        """ returns the slots in the current window, oldest first. Pass window_limit to only get the slots
+            which ended after it (a shorter window).
+        """
+        if window_limit is None:
+            window_limit = self.window_limit
+        first_id = None
+        if window_limit is not None:
+            first_id = int(window_limit // self.slot_size)
+        slots = [s for s in self.slots if s.id is not None and (first_id is None or s.id >= first_id)]
+        slots.sort(key=lambda s: s.id)
+        return slots
+
+    def count(self):
+        return sum([s.count for s in self.get_slots()], 0)
+
+    def sum(self):
+        return sum([s.sum for s in self.get_slots()], 0.0)
+
+    def max(self):
+        values = [s.max for s in self.get_slots() if s.count]
+        return max(values) if values else None
+
+    def min(self):
+        values = [s.min for s in self.get_slots() if s.count]
+        return min(values) if values else None
+
+    def start_time(self):
+        for s in self.get_slots():
+            if s.count:
+                return s.start_time
+        return None
+
+    def estimated(self):
+        return False
+
+
+class DeltaWindow(object):
+    """ aggregates every value added since the window was created, for counters in delta mode. Constant memory and
+        no per value timestamps. Counters replace the window with a new one to start a new interval.
+
+        start_time - the start of the interval.
+    """
+
+    def __init__(self, start_time):
+        self.interval_start = start_time
+        self.slot = WindowSlot()
+
+    def add(self, value, time, weight=1):
+        self.slot.add(value, time, weight)
+
+    def trim(self, window_limit):
+        pass
+
+    def clear(self):
+        self.slot.reset(None)
+
+    def count(self):
+        return self.slot.count
+
+    def sum(self):
+        return self.slot.sum
+
+    def max(self):
+        return self.slot.max
+
+    def min(self):
+        return self.slot.min
+
+    def start_time(self):
+        """ the start of the interval. None if empty. """
+        return self.interval_start if self.slot.count else None
+
+    def estimated(self):
+        return False
@@ -201,13 +201,14 @@ class MultiProcessCounterValueCollector(CounterValuesCollector):
         return None  # not a leader. Life sucks.
 
     def merge_values(self, values):
-        merged_collection = CounterValueCollection()
         original_values = {}
         for node, report in values.iteritems():
-            self.debug_log.debug("Merging report from %s", node)
-            merged_collection.merge_with(report)
+            # before merging, as merging may reuse the reported values.
             original_values[node] = report.values
 
+        self.debug_log.debug("Merging reports from %s nodes", len(values))
+        merged_collection = CounterValueCollection.merge_all(values.values())
+
         res = merged_collection.values
         res["__node_reports__"] = original_values
         return res
@@ -1,4 +1,7 @@
-from functools import wraps
+from functools import wraps, partial
+import random
+import sys
+from time import time as current_time
 import base
 import counters
 
@@ -20,7 +23,7 @@ def value(name, value, auto_add_counter=counters.AverageWindowCounter):
         if not cntr:
             base.GLOBAL_REGISTRY.add_counter(auto_add_counter(name), throw=False)
 
-    base.THREAD_DISPATCHER.dispatch_event(name, "value", value)
+    base.report_event(name, "value", value)
 
 
 def occurrence(name, auto_add_counter=counters.FrequencyCounter):
@@ -32,7 +35,7 @@ def occurrence(name, auto_add_counter=counters.FrequencyCounter):
         if not cntr:
             base.GLOBAL_REGISTRY.add_counter(auto_add_counter(name), throw=False)
 
-    base.THREAD_DISPATCHER.dispatch_event(name, "end", None)
+    base.report_event(name, "end", None)
 
 
 def frequency(name=None, auto_add_counter=counters.FrequencyCounter):
@@ -43,53 +46,170 @@ def frequency(name=None, auto_add_counter=counters.FrequencyCounter):
     return _reporting_decorator_context_manager(name, auto_add_counter=auto_add_counter)
 
 
-def time(name=None, auto_add_counter=counters.AverageTimeCounter):
+def time(name=None, auto_add_counter=counters.AverageTimeCounter, generator=False):
     """
         A shortcut decorator to count the average execution time of a function. Uses the :obj:`counters.AverageTimeCounter` counter by default.
         If the parameter name is not supplied events are reported under the name of the wrapped function.
+        Pass generator=True to decorate a generator function: the execution then spans the iteration of the
+        generator, from its first item until it is exhausted or closed.
     """
-    return _reporting_decorator_context_manager(name, auto_add_counter=auto_add_counter)
+    return _reporting_decorator_context_manager(name, auto_add_counter=auto_add_counter, generator=generator)
+
+
+def concurrency(name=None, auto_add_counter=counters.ConcurrencyCounter, generator=False):
+    """
+        A shortcut decorator to count the number of concurrent executions of a function. Uses the :obj:`counters.ConcurrencyCounter` counter by default.
+        If the parameter name is not supplied events are reported under the name of the wrapped function.
+        Pass generator=True to decorate a generator function: the execution then spans the iteration of the
+        generator, from its first item until it is exhausted or closed.
+    """
+    return _reporting_decorator_context_manager(name, auto_add_counter=auto_add_counter, generator=generator)
+
+
+def _report_iteration(iterator, start, end):
+    """ iterates over iterator, calling start before the first item is produced and end when iteration stops.
+        Iterations may interleave, so rather than leaving it to timers to pair the start and end, the start gets
+        the start time as its param and the end gets the elapsed time (see TimerMixin).
+        Values sent and exceptions thrown into the iteration are forwarded to iterator, as with PEP 380's yield from.
+    """
+    start_time = current_time()
+    start(start_time)
+    try:
+        item = next(iterator)
+        while True:
+            try:
+                sent = yield item
+            except GeneratorExit:
+                raise  # iterator is closed below
+            except BaseException:
+                throw = getattr(iterator, "throw", None)
+                if throw is None:
+                    raise
+                item = throw(*sys.exc_info())
+            else:
+                if sent is None:
+                    item = next(iterator)
+                else:
+                    item = iterator.send(sent)
+    except StopIteration:
+        pass
+    finally:
+        ## make sure calls are balanced, also when the consumer stops early
+        end(current_time() - start_time)
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
 
 
 class _reporting_decorator_context_manager(object):
 
-    def __init__(self, name, auto_add_counter=None):
+    def __init__(self, name, auto_add_counter=None, sample_rate=None, generator=False):
         self.name = name
+        self.generator = generator  # the decorated function is a generator function, time its consumption
         self.auto_add_counter = auto_add_counter
-        if auto_add_counter and name:
-            # we have a name, we can register things now. O.w. this must be used as a decorator.
-            # name will be registered then and there.
-            cntr = base.GLOBAL_REGISTRY.get_counter(name, throw=False)
-            if not cntr:
-                base.GLOBAL_REGISTRY.add_counter(auto_add_counter(name), throw=True)
+        if sample_rate is not None and not 0 < sample_rate <= 1:
+            raise ValueError("sample_rate must be in (0, 1], got %s" % (sample_rate, ))
+        self.sample_rate = sample_rate  # overrides the sample rate of the event handle
+        self.handle = None
+        self._decisions = dict()  # task identity -> stack of the decisions of __enter__ (see there)
+        if name:
+            self.handle = base.event_handle(name)
+            if auto_add_counter:
+                # we have a name, we can register things now. O.w. this must be used as a decorator.
+                # name will be registered then and there.
+                cntr = base.GLOBAL_REGISTRY.get_counter(name, throw=False)
+                if not cntr:
+                    base.GLOBAL_REGISTRY.add_counter(auto_add_counter(name), throw=True)
 
     def __call__(self, f):
-        event_name = self.name
-        if not self.name:
+        handle = self.handle
+        if not handle:
             event_name = f.__name__
+            handle = base.event_handle(event_name)
             # we don't have stored name... counter needs to be registered.
             if self.auto_add_counter:
                 cntr = base.GLOBAL_REGISTRY.get_counter(event_name, throw=False)
                 if not cntr:
                     base.GLOBAL_REGISTRY.add_counter(self.auto_add_counter(event_name), throw=True)
 
+        # enabled is checked once per call, so these don't check it again: an end matches every start.
+        start = handle._start
+        end = handle._end
+        sampled = handle.sampled
+        sample_rate = self.sample_rate
+
+        if self.generator:
+            @wraps(f)
+            def generator_wrapper(*args, **kwargs):
+                if not handle.enabled:
+                    return f(*args, **kwargs)
+                rate = handle.sample_rate if sample_rate is None else sample_rate
+                if rate < 1.0:
+                    if random.random() >= rate:
+                        return f(*args, **kwargs)
+                    return _report_iteration(f(*args, **kwargs), partial(sampled, "start", rate=rate),
+                                             partial(sampled, "end", rate=rate))
+                return _report_iteration(f(*args, **kwargs), start, end)
+
+            return generator_wrapper
+
         @wraps(f)
         def wrapper(*args, **kwargs):
-
-            base.THREAD_DISPATCHER.dispatch_event(event_name, "start", None)
+            if not handle.enabled:
+                return f(*args, **kwargs)
+            rate = handle.sample_rate if sample_rate is None else sample_rate
+            if rate < 1.0:
+                if random.random() >= rate:
+                    return f(*args, **kwargs)
+                sampled("start", None, rate)
+                try:
+                    r = f(*args, **kwargs)
+                finally:
+                    sampled("end", None, rate)
+                return r
+
+            start()
             try:
                 r = f(*args, **kwargs)
             finally:
                 ## make sure calls are balanced
-                base.THREAD_DISPATCHER.dispatch_event(event_name, "end", None)
+                end()
             return r
 
         return wrapper
 
+    def _get_rate(self):
+        return self.handle.sample_rate if self.sample_rate is None else self.sample_rate
+
     def __enter__(self):
         if not self.name:
             raise Exception("PyCounters context manager used without defining a name.")
-        base.THREAD_DISPATCHER.dispatch_event(self.name, "start", None)
+        # remember the decision, so that __exit__ matches it even if the rate or the switch changes meanwhile
+        decisions = self._decisions.setdefault(base.get_task_identity(), [])
+        handle = self.handle
+        if not handle.enabled:
+            decisions.append(None)
+            return
+        rate = self._get_rate()
+        if rate < 1.0:
+            if random.random() >= rate:
+                decisions.append(None)
+                return
+            decisions.append(rate)
+            handle.sampled("start", None, rate)
+            return
+        decisions.append(1.0)
+        handle._start()
 
     def __exit__(self, *args, **kwargs):
-        base.THREAD_DISPATCHER.dispatch_event(self.name, "end", None)
+        task = base.get_task_identity()
+        decisions = self._decisions[task]
+        rate = decisions.pop()
+        if not decisions:
+            del self._decisions[task]
+        if rate is None:
+            return
+        if rate < 1.0:
+            self.handle.sampled("end", None, rate)
+        else:
+            self.handle._end()
@@ -1,5 +1,6 @@
 from time import time
 from threading import local as threading_local
+from ..base import get_task_identity
 
 
 class Timer(object):
@@ -36,3 +37,65 @@ class Timer(object):
 
 class ThreadLocalTimer(threading_local, Timer):
     pass
+
+
+class TaskLocalTimer(Timer):
+    """ a timer which keeps separate time for every task (see pycounters.base.get_task_identity), so tasks
+        interleaving on a single thread don't overwrite each other's start time.
+
+        Starting the timer while it runs (e.g. in a nested or recursive call) starts a nested timing, which the next
+        stop() ends. The time of a nested timing is included in the time of the enclosing one, unless stopped with
+        exclusive=True .
+    """
+
+    def __init__(self):
+        # task identity -> stack of timings: [start time, accumulated time, running, time of nested timings]
+        self._tasks = dict()
+
+    def start(self):
+        """ start timing """
+        ct = self._get_current_time()
+        task = get_task_identity()
+        timings = self._tasks.get(task)
+        if timings is None:
+            self._tasks[task] = [[ct, 0.0, True, 0.0]]
+        elif timings[-1][2]:
+            timings.append([ct, 0.0, True, 0.0])
+        else:  # paused, continue it
+            timing = timings[-1]
+            timing[0] = ct
+            timing[2] = True
+
+    def stop(self, exclusive=False):
+        """ stops the innermost timing, returning its accumulated time, or None if the timer wasn't started by this
+            task. With exclusive=True, returns the time spent outside of the timing's nested timings.
+        """
+        t = self.pause()
+        if t is None:
+            return None
+        task = get_task_identity()
+        timings = self._tasks[task]
+        nested = timings.pop()[3]
+        if timings:
+            timings[-1][3] += t
+        else:
+            del self._tasks[task]
+        return t - nested if exclusive else t
+
+    def pause(self):
+        """ pauses the innermost timing returning its accumulated time so far, or None if the timer wasn't started by
+            this task.
+        """
+        ct = self._get_current_time()
+        timings = self._tasks.get(get_task_identity())
+        if not timings:
+            return None
+        timing = timings[-1]
+        if timing[2]:
+            timing[1] += ct - timing[0]
+            timing[2] = False
+        return timing[1]
+
+    def get_accumulated_time(self):
+        timings = self._tasks.get(get_task_identity())
+        return timings[-1][1] if timings else 0.0
@@ -1,4 +1,5 @@
 import logging
+import random
 import unittest
 import threading
 from time import sleep
@@ -6,14 +7,133 @@ from pycounters import register_counter, register_reporter, report_value, unregi
 
 from pycounters.base import CounterValueCollection
 from pycounters.counters import TotalCounter
-from pycounters.counters.values import AccumulativeCounterValue
+from pycounters.counters import values
+from pycounters.counters.values import AccumulativeCounterValue, HistogramCounterValue, AverageCounterValue, \
+    MaxCounterValue, MinCounterValue, VarianceCounterValue, \
+    CardinalityCounterValue
 from pycounters.reporters.base import CollectingRole, MultiProcessCounterValueCollector
 from pycounters.reporters.tcpcollection import CollectingLeader, CollectingNode, elect_leader
 from tests.counter_tests import SimpleValueReporter
 
 
+class OfflineCollector(MultiProcessCounterValueCollector):
+    """ a collector which doesn't connect to anything. Used to test merging. """
+
+    def init_role(self):
+        pass
+
+
 class CollectorTests(unittest.TestCase):
 
+    def test_merge_all(self):
+        rnd = random.Random(0)
+        value_factories = [
+            lambda: AverageCounterValue(rnd.choice([None, rnd.random()]), rnd.randint(0, 5)),
+            lambda: AccumulativeCounterValue(rnd.choice([None, 0, rnd.randint(-5, 5)])),
+            lambda: MaxCounterValue(rnd.choice([None, rnd.random()])),
+            lambda: MinCounterValue(rnd.choice([None, rnd.random()])),
+            lambda: rnd.choice([AccumulativeCounterValue(1), MaxCounterValue(2)]),  # mixed
+        ]
+
+        def make_reports():
+            rnd.seed(1)
+            reports = []
+            for node in range(20):
+                c = CounterValueCollection()
+                for k in range(50):
+                    if rnd.random() < 0.8:
+                        c["c%d" % k] = value_factories[k % len(value_factories)]()
+                reports.append(c)
+            return reports
+
+        incremental = CounterValueCollection()
+        for report in make_reports():
+            incremental.merge_with(report)
+        incremental = incremental.values
+        merged = CounterValueCollection.merge_all(make_reports()).values
+
+        self.assertEqual(sorted(merged.keys()), sorted(incremental.keys()))
+        for k, v in incremental.iteritems():
+            if isinstance(v, float):
+                self.assertAlmostEqual(merged[k], v)
+            else:
+                self.assertEqual(merged[k], v)
+
+        unmergeable = CounterValueCollection(a=1)
+        self.assertRaises(Exception, CounterValueCollection.merge_all, [unmergeable, unmergeable])
+
+    def test_merge_groups_numpy(self):
+        if values.numpy is None:
+            self.skipTest("numpy is not installed")
+        rnd = random.Random(0)
+        value_factories = [
+            (AverageCounterValue, lambda: AverageCounterValue(rnd.choice([None, rnd.random()]), rnd.randint(0, 5))),
+            (MaxCounterValue, lambda: MaxCounterValue(rnd.choice([None, rnd.random()]))),
+            (MinCounterValue, lambda: MinCounterValue(rnd.choice([None, rnd.random()]))),
+        ]
+
+        def merge(cls, factory):
+            rnd.seed(1)
+            groups = [[factory() for i in range(rnd.randint(1, 10))] for group in range(50)]
+            return [v.value for v in cls.merge_groups(groups)]
+
+        numpy = values.numpy
+        for cls, factory in value_factories:
+            with_numpy = merge(cls, factory)
+            values.numpy = None
+            try:
+                without_numpy = merge(cls, factory)
+            finally:
+                values.numpy = numpy
+            self.assertEqual(len(with_numpy), len(without_numpy))
+            for a, b in zip(with_numpy, without_numpy):
+                if a is None or b is None:
+                    self.assertEqual(a, b)
+                else:
+                    self.assertAlmostEqual(a, b)
+
+    def test_merge_histograms(self):
+        reports = {}
+        for node in range(3):
+            c = CounterValueCollection()
+            c["h"] = HistogramCounterValue(precision=3)
+            for i in range(node * 10, node * 10 + 10):
+                c["h"].add(i)
+            reports[node] = c
+
+        merged = OfflineCollector().merge_values(reports)
+        self.assertEqual(merged["h.count"], 30)
+        self.assertEqual((merged["h.min"], merged["h.max"]), (0, 29))
+        self.assertTrue(abs(merged["h.p50"] - 15) <= 15 * 2 ** -4)
+        self.assertEqual(merged["__node_reports__"][1]["h.count"], 10)
+
+    def test_merge_variances(self):
+        reports = {}
+        for node in range(3):
+            c = CounterValueCollection()
+            c["v"] = VarianceCounterValue()
+            for i in range(node * 10, node * 10 + 10):
+                c["v"].add(i)
+            reports[node] = c
+
+        merged = OfflineCollector().merge_values(reports)
+        self.assertEqual(merged["v.count"], 30)
+        self.assertAlmostEqual(merged["v.mean"], 14.5)
+        self.assertAlmostEqual(merged["v.variance"], (30 ** 2 - 1) / 12.0)
+
+    def test_merge_cardinalities(self):
+        reports = {}
+        for node in range(3):
+            c = CounterValueCollection()
+            c["users"] = CardinalityCounterValue(precision=10)
+            for i in range(node * 50, node * 50 + 100):
+                c["users"].add(i)
+            reports[node] = c
+
+        merged = OfflineCollector().merge_values(reports)
+        self.assertTrue(abs(merged["users"] - 200) < 200 * 0.05)
+        self.assertTrue(abs(merged["__node_reports__"][1]["users"] - 100) < 100 * 0.05)
+
     def test_basic_collection(self):
         test1 = TotalCounter("test1")
         register_counter(test1)
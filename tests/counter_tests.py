@@ -1,25 +1,40 @@
+import math
 import os
+import random
+import threading
 import unittest
 from time import sleep
 
 from pycounters import register_counter, report_start_end, unregister_counter, register_reporter, \
-    start_auto_reporting, unregister_reporter, stop_auto_reporting, report_value, output_report
+    start_auto_reporting, unregister_reporter, stop_auto_reporting, report_value, output_report, event_handle, \
+    start_async_dispatch, stop_async_dispatch, disable, enable, is_enabled, report_start, report_end, \
+    set_task_identity
 
-from pycounters.base import CounterRegistry, THREAD_DISPATCHER, EventDispatcher
+from pycounters import base
+from pycounters.base import CounterRegistry, THREAD_DISPATCHER, EventDispatcher, BaseListener, GLOBAL_REGISTRY, \
+    AsyncEventQueue
 
 from pycounters.counters import EventCounter, AverageWindowCounter, AverageTimeCounter, FrequencyCounter, \
-    ValueAccumulator, ThreadTimeCategorizer, TotalCounter, MinWindowCounter, MaxWindowCounter
+    ValueAccumulator, ThreadTimeCategorizer, TotalCounter, WindowCounter, MinWindowCounter, MaxWindowCounter, \
+    HistogramCounter, HistogramTimeCounter, QuantileSketchCounter, EWMARateCounter, EWMAAverageCounter, \
+    SummaryCounter, SummaryTimeCounter, \
+    VarianceWindowCounter, VarianceTimeCounter, CardinalityCounter, TopKCounter, \
+    ConcurrencyCounter, MultiAverageWindowCounter, MultiAverageTimeCounter, CounterFamily
 
 
+from pycounters.counters.windows import DequeWindow, BucketWindow
 from pycounters.counters.values import AccumulativeCounterValue, \
-    MinCounterValue, MaxCounterValue, AverageCounterValue
+    MinCounterValue, MaxCounterValue, AverageCounterValue, HistogramCounterValue, \
+    QuantileSketchCounterValue, EWMARateCounterValue, EWMAAverageCounterValue, SummaryCounterValue, \
+    VarianceCounterValue, CardinalityCounterValue, TopKCounterValue, ConcurrencyCounterValue, \
+    MultiAverageCounterValue, FamilyCounterValue
 
 from pycounters.reporters import JSONFileReporter
 from pycounters.reporters.base import BaseReporter
 
-from pycounters.shortcuts import count, value, frequency, time
+from pycounters.shortcuts import count, value, frequency, time, concurrency
 from . import EventCatcher
-from pycounters.utils.timer import ThreadLocalTimer, Timer
+from pycounters.utils.timer import ThreadLocalTimer, Timer, TaskLocalTimer
 
 
 class FakeThreadLocalTimer(ThreadLocalTimer):
@@ -33,6 +48,16 @@ class FakeThreadLocalTimer(ThreadLocalTimer):
         return self.curtime
 
 
+class FakeTaskLocalTimer(TaskLocalTimer):
+    """ advances time by one on every reading """
+
+    curtime = -1
+
+    def _get_current_time(self):
+        self.curtime += 1
+        return self.curtime
+
+
 class SimpleValueReporter(BaseReporter):
     def output_values(self, counter_values):
         self.last_values = counter_values
@@ -53,6 +78,20 @@ class FakeTimer(Timer):
         return self.curtime
 
 
+class FakeTime(object):
+    """ a counter mixin whose current time is the now attribute. Set it to move time. """
+
+    now = 100.0
+
+    def _get_current_time(self):
+        return self.now
+
+
+def fake_time(counter_class, now=100.0):
+    """ returns a sub class of counter_class with FakeTime, starting at now """
+    return type("Fake" + counter_class.__name__, (FakeTime, counter_class), dict(now=now))
+
+
 class CounterTests(unittest.TestCase):
     def test_ThreadTimeCategorizer(self):
         tc = ThreadTimeCategorizer("tc", ["cat1", "cat2", "f"], timer_class=FakeTimer)
@@ -161,6 +200,169 @@ class CounterTests(unittest.TestCase):
         f.start()
         self.assertEqual(f.stop(), 2)
 
+    def test_task_identity(self):
+        c = AverageTimeCounter("tasks")
+        c.timer = FakeTaskLocalTimer()
+        register_counter(c)
+        current = ["a"]
+        set_task_identity(lambda: current[0])
+        try:
+            report_start("tasks")  # a starts at 0
+            current[0] = "b"
+            report_start("tasks")  # b starts at 1
+            current[0] = "a"
+            report_end("tasks")  # a ends at 2
+            current[0] = "b"
+            report_end("tasks")  # b ends at 3
+            self.assertEquals(c.get_value().value, 2)
+            self.assertEquals(c.timer._tasks, {})
+        finally:
+            set_task_identity(None)
+            unregister_counter(counter=c)
+
+    def test_task_identity_context_manager(self):
+        c = AverageTimeCounter("sampled_tasks")
+        c.timer = FakeTaskLocalTimer()
+        register_counter(c)
+        current = ["a"]
+        set_task_identity(lambda: current[0])
+        try:
+            cm = report_start_end("sampled_tasks", sample_rate=0.5)
+            random.seed(1)
+            for i in range(200):
+                current[0] = "a"
+                cm.__enter__()
+                current[0] = "b"
+                cm.__enter__()
+                current[0] = "a"
+                cm.__exit__(None, None, None)
+                current[0] = "b"
+                cm.__exit__(None, None, None)
+            # every task's exit matched its own enter's sampling decision.
+            self.assertEquals(cm._decisions, {})
+            self.assertEquals(c.timer._tasks, {})
+        finally:
+            set_task_identity(None)
+            unregister_counter(counter=c)
+
+    def test_nested_timing(self):
+        inclusive = AverageTimeCounter("nested")
+        inclusive.timer = FakeTaskLocalTimer()
+        exclusive = AverageTimeCounter("nested_exclusive", events=["nested"], exclusive=True)
+        exclusive.timer = FakeTaskLocalTimer()
+        register_counter(inclusive)
+        register_counter(exclusive)
+        try:
+            @report_start_end("nested")
+            def f(n):
+                if n:
+                    f(n - 1)
+
+            f(1)  # outer starts at 0, inner from 1 to 2, outer ends at 3
+            self.assertEquals(inclusive.get_value().value, 2)  # (1 + 3) / 2
+            self.assertEquals(exclusive.get_value().value, 1.5)  # (1 + 2) / 2
+        finally:
+            unregister_counter(counter=inclusive)
+            unregister_counter(counter=exclusive)
+
+    def test_generator_timing(self):
+        @report_start_end("gen", generator=True)
+        def g():
+            yield 1
+            yield 2
+
+        events = []
+        with EventCatcher(events):
+            it = g()
+            self.assertEquals(events, [])
+            self.assertEquals(it.next(), 1)
+            self.assertEquals([e[:2] for e in events], [("gen", "start")])
+            self.assertEquals(list(it), [2])
+            self.assertEquals([e[:2] for e in events], [("gen", "start"), ("gen", "end")])
+
+            del events[:]
+            it = g()
+            it.next()
+            it.close()  # stopped early
+            self.assertEquals([e[:2] for e in events], [("gen", "start"), ("gen", "end")])
+
+        @report_start_end("gen", generator=True)
+        def accumulate():
+            total = 0
+            try:
+                while True:
+                    try:
+                        total += yield total
+                    except ValueError:
+                        total = 0
+            finally:
+                closed.append(total)
+
+        closed = []
+        events = []
+        with EventCatcher(events):
+            it = accumulate()
+            self.assertEquals(it.next(), 0)
+            self.assertEquals(it.send(2), 2)
+            self.assertEquals(it.send(3), 5)
+            self.assertEquals(it.throw(ValueError), 0)  # handled by the generator
+            self.assertEquals(it.send(4), 4)
+            self.assertRaises(KeyError, it.throw, KeyError)  # not handled, ends the iteration
+            self.assertEquals(closed, [4])
+            self.assertEquals([e[:2] for e in events], [("gen", "start"), ("gen", "end")])
+
+            it = accumulate()
+            it.next()
+            it.send(1)
+            it.close()
+            self.assertEquals(closed, [4, 1])
+
+    def test_interleaved_generator_timing(self):
+        c = AverageTimeCounter("gen_time")
+        register_counter(c)
+        try:
+            @time("gen_time", generator=True)
+            def g():
+                yield 1
+                yield 2
+
+            a = g()
+            a.next()
+            sleep(0.2)
+            b = g()
+            b.next()
+            list(a)  # a ends first
+            list(b)
+            a_time, b_time = c.values
+            self.assertTrue(a_time >= 0.2)
+            self.assertTrue(b_time < 0.1)
+            self.assertEquals(c.timer, None)  # not timed by the counter
+        finally:
+            unregister_counter(counter=c)
+
+    def test_thread_listeners_of_ended_thread(self):
+        events = []
+        count = THREAD_DISPATCHER.active_listeners_count
+
+        def add_listener():
+            # never removed
+            THREAD_DISPATCHER.add_listener(EventCatcher(events).create_listener(events))
+
+        t = threading.Thread(target=add_listener)
+        t.start()
+        t.join()
+        for _ in range(100):  # thread local storage is released shortly after join returns
+            if THREAD_DISPATCHER.active_listeners_count == count:
+                break
+            sleep(0.01)
+        self.assertEquals(THREAD_DISPATCHER.active_listeners_count, count)
+
+        later = [threading.Thread(target=report_value, args=("x", 1)) for _ in range(5)]
+        for t in later:
+            t.start()
+            t.join()
+        self.assertEquals(events, [])
+
     def test_one_counter_multiple_events(self):
         test = TotalCounter("test", events=["test1", "test2"])
         register_counter(test)
@@ -289,6 +491,809 @@ class CounterTests(unittest.TestCase):
         test.report_event("test", "value", 1)
         self.assertEquals(test.get_value().value, 1.0)
 
+    def test_bucketed_window_counters(self):
+        counters = [fake_time(c, 1000.0)("test", window_size=10, buckets=5) for c in
+                    [AverageWindowCounter, MaxWindowCounter, MinWindowCounter, FrequencyCounter]]
+        for c in counters:
+            self.assertEquals(c.get_value().value, None if not isinstance(c, FrequencyCounter) else 0.0)
+            c.report_event("test", "value", 1)
+            c.now += 3
+            c.report_event("test", "value", 3)
+            c.now += 1
+
+        self.assertEquals([c.get_value().value for c in counters], [2.0, 3.0, 1.0, 1.0])
+
+        for c in counters:
+            # the slot of the first value is out of the window.
+            c.now += 8
+        self.assertEquals([c.get_value().value for c in counters], [3.0, 3.0, 3.0, 3.0 / 9])
+
+        for c in counters:
+            c.now += 10
+        self.assertEquals([c.get_value().value for c in counters], [None, None, None, 0.0])
+
+    def test_bucket_window_late_values(self):
+        for buckets in [1, 5]:
+            w = BucketWindow(10, buckets)
+            w.add(1, 100.0)
+            w.add(2, 110.0)  # reuses the slot of the first value
+            w.add(3, 100.5)  # reported late, its slot was already reused
+            self.assertEquals((w.count(), w.sum()), (1, 2.0))
+
+    def test_deque_window_max_min_tracking(self):
+        rnd = random.Random(1)
+        tracked = DequeWindow(track_max=True, track_min=True)
+        scanned = DequeWindow()
+        for t in range(1000):
+            v = rnd.randint(0, 50)
+            tracked.add(v, t)
+            scanned.add(v, t)
+            if t % 7 == 0:
+                limit = t - rnd.randint(0, 30)
+                tracked.trim(limit)
+                scanned.trim(limit)
+            self.assertEquals((tracked.max(), tracked.min()), (max(scanned.values), min(scanned.values)))
+
+        tracked.trim(1000)
+        self.assertEquals((tracked.max(), tracked.min()), (None, None))
+
+    def test_deque_window_running_sum(self):
+        rnd = random.Random(1)
+        window = DequeWindow()
+        for t in range(20000):
+            window.add(rnd.choice([0.1, 1e9, 1e-7, 3.3333]), t)
+            window.trim(t - 100)
+            self.assertAlmostEqual(window.sum(), math.fsum(window.values), places=6)
+
+        window.trim(20000)
+        self.assertEquals(window.sum(), 0.0)
+
+    def test_histogram_counter(self):
+        h = HistogramCounter("h", precision=7)
+        register_counter(h)
+        v = SimpleValueReporter()
+        register_reporter(v)
+        try:
+            for i in range(1, 1001):
+                report_value("h", i)
+
+            output_report()
+            values = v.values_wo_metadata
+            self.assertEquals(sorted(values.keys()),
+                              ["h.count", "h.max", "h.min", "h.p50", "h.p90", "h.p99", "h.p999"])
+            self.assertEquals((values["h.count"], values["h.min"], values["h.max"]), (1000, 1, 1000))
+            for k, expected in [("h.p50", 500), ("h.p90", 900), ("h.p99", 990), ("h.p999", 999)]:
+                self.assertTrue(abs(values[k] - expected) <= expected * 2 ** -8, (k, values[k]))
+        finally:
+            unregister_counter(counter=h)
+            unregister_reporter(v)
+
+        # slot value counters can't keep every value.
+        for counter_class in [HistogramCounter, QuantileSketchCounter, CardinalityCounter]:
+            self.assertRaises(ValueError, counter_class, "h", buckets=None)
+
+    def test_histogram_counter_value(self):
+        a = HistogramCounterValue(precision=4)
+        b = HistogramCounterValue(precision=4)
+        for i in range(90):
+            a.add(1.0)
+        for i in range(10):
+            b.add(100.0)
+        b.add(0)
+        a.merge_with(b)
+        a.merge_with(HistogramCounterValue(precision=4))
+        self.assertEquals(a.value, dict(count=101, min=0, max=100.0, p50=1.03125, p90=1.03125, p99=100.0, p999=100.0))
+        self.assertRaises(Exception, a.merge_with, HistogramCounterValue(precision=5))
+        self.assertEquals(HistogramCounterValue().value["p50"], None)
+
+    def test_quantile_sketch_counter(self):
+        try:
+            for i in range(-100, 1001):
+                value("qs", i * 1.5, auto_add_counter=QuantileSketchCounter)
+
+            values = GLOBAL_REGISTRY.get_counter("qs").get_value().value
+            self.assertEquals((values["count"], values["min"], values["max"]), (1101, -150.0, 1500.0))
+            for k, expected in [("p50", 675.0), ("p90", 1335.0), ("p99", 1483.5)]:
+                self.assertTrue(abs(values[k] - expected) <= expected * 0.01, (k, values[k]))
+        finally:
+            unregister_counter(name="qs")
+
+    def test_quantile_sketch_counter_value(self):
+        a = QuantileSketchCounterValue(relative_accuracy=0.05, max_bins=4)
+        b = QuantileSketchCounterValue(relative_accuracy=0.05, max_bins=4)
+        for v in [-10.0, 0.0, 1.0, 2.0]:
+            a.add(v)
+        for v in [100.0, 200.0, 400.0]:
+            b.add(v)
+        a.merge_with(b)
+        self.assertEquals(len(a.positive_bins), 4)  # lowest bins are collapsed
+        self.assertEquals(a.get_percentile(0), -10.0)
+        self.assertEquals(a.get_percentile(1.0 / 6), 0.0)
+        self.assertTrue(abs(a.get_percentile(1) - 400) <= 400 * 0.05)
+        self.assertRaises(Exception, a.merge_with, QuantileSketchCounterValue(relative_accuracy=0.01))
+
+    def test_ewma_counters(self):
+        rate = fake_time(EWMARateCounter, 0.0)("test", tick_interval=5, horizons=[("short", 5.0), ("long", 500.0)])
+        average = fake_time(EWMAAverageCounter, 0.0)("test", tick_interval=5,
+                                                     horizons=[("short", 5.0), ("long", 500.0)])
+        counters = [rate, average]
+        for c in counters:
+            self.assertEquals(c.get_value().value, {"short": None, "long": None})
+            c.report_event("test", "value", 10)
+            c.report_event("test", "value", 20)
+            c.now = 5.0
+        self.assertEquals(rate.get_value().value, {"short": 6.0, "long": 6.0})
+        self.assertEquals(average.get_value().value, {"short": 15.0, "long": 15.0})
+
+        for c in counters:
+            c.report_event("test", "value", 40)
+            c.now = 20.0  # a tick with 40 and two empty ones
+
+        alpha_short = 1 - math.exp(-1)
+        alpha_long = 1 - math.exp(-0.01)
+        long_sum = (30 + alpha_long * (40 - 30)) * (1 - alpha_long) ** 2
+        short_sum = (30 + alpha_short * (40 - 30)) * (1 - alpha_short) ** 2
+        values = rate.get_value().value
+        self.assertAlmostEqual(values["short"], short_sum / 5)
+        self.assertAlmostEqual(values["long"], long_sum / 5)
+
+        long_count = (2 + alpha_long * (1 - 2)) * (1 - alpha_long) ** 2
+        self.assertAlmostEqual(average.get_value().value["long"], long_sum / long_count)
+
+        # events dispatched late are added to the tick they were reported in.
+        reported = fake_time(EWMARateCounter, 0.0)("test", tick_interval=5)
+        dispatched = fake_time(EWMARateCounter, 0.0)("test", tick_interval=5)
+        for c in [reported, dispatched]:
+            c.report_event("test", "value", 10)
+        reported.now = 3.0
+        reported.report_event("test", "value", 20)
+        dispatched.now = 12.0
+        base.EVENT_CONTEXT.time = 3.0
+        try:
+            dispatched.report_event("test", "value", 20)
+        finally:
+            base.EVENT_CONTEXT.time = None
+        reported.now = 12.0
+        self.assertEquals(dispatched.get_value().value, reported.get_value().value)
+
+    def test_ewma_counter_values(self):
+        a = EWMARateCounterValue({"1m": 1.0, "5m": None})
+        a.merge_with(EWMARateCounterValue({"1m": 2.0, "5m": 3.0}))
+        self.assertEquals(a.value, {"1m": 3.0, "5m": 3.0})
+
+        a = EWMAAverageCounterValue({"1m": 10.0, "5m": None}, {"1m": 1.0, "5m": None})
+        a.merge_with(EWMAAverageCounterValue({"1m": 50.0, "5m": 6.0}, {"1m": 4.0, "5m": 2.0}))
+        self.assertEquals(a.value, {"1m": 12.0, "5m": 3.0})
+
+    def test_summary_counter(self):
+        FakeSummaryCounter = fake_time(SummaryCounter)
+
+        for buckets in [None, 10]:
+            c = FakeSummaryCounter("s", window_size=10, buckets=buckets)
+            self.assertEquals(c.get_value().value,
+                              dict(count=0, sum=0.0, min=None, max=None, mean=None, rate=None))
+            for v in [3, 1, 2]:
+                c.report_event("s", "value", v)
+                c.now += 1
+            self.assertEquals(c.get_value().value, dict(count=3, sum=6.0, min=1, max=3, mean=2.0, rate=1.0))
+
+    def test_summary_counter_value(self):
+        a = SummaryCounterValue(2, 4.0, 1, 3, 0.5)
+        a.merge_with(SummaryCounterValue())
+        a.merge_with(SummaryCounterValue(2, 16.0, 7, 9, 1.0))
+        self.assertEquals(a.value, dict(count=4, sum=20.0, min=1, max=9, mean=5.0, rate=1.5))
+
+        v = SimpleValueReporter()
+        register_reporter(v)
+        c = SummaryTimeCounter("st")
+        register_counter(c)
+        try:
+            @time("st")
+            def f():
+                pass
+            f()
+            output_report()
+            self.assertEquals(sorted(v.values_wo_metadata.keys()),
+                              ["st.count", "st.max", "st.mean", "st.min", "st.rate", "st.sum"])
+            self.assertEquals(v.values_wo_metadata["st.count"], 1)
+        finally:
+            unregister_counter(counter=c)
+            unregister_reporter(v)
+
+    def test_variance_counter(self):
+        FakeVarianceCounter = fake_time(VarianceWindowCounter)
+
+        for buckets in [None, 10]:
+            c = FakeVarianceCounter("v", window_size=10, buckets=buckets)
+            self.assertEquals(c.get_value().value, dict(count=0, mean=None, variance=None, stddev=None))
+            for v in [2, 4, 4, 4, 5, 5, 7, 9]:
+                c.report_event("v", "value", v)
+            self.assertEquals(c.get_value().value, dict(count=8, mean=5.0, variance=4.0, stddev=2.0))
+            c.now += 20
+            self.assertEquals(c.get_value().value["count"], 0)
+
+    def test_variance_counter_value(self):
+        # large offsets lose all precision with the naive sum of squares formula.
+        values = [1e9 + random.gauss(0, 1) for i in range(1000)]
+        mean = math.fsum(values) / len(values)
+        variance = math.fsum([(v - mean) ** 2 for v in values]) / len(values)
+
+        parts = [VarianceCounterValue() for i in range(3)]
+        for i, v in enumerate(values):
+            parts[i % 7 % 3].add(v)
+        merged = VarianceCounterValue()
+        merged.merge_with(VarianceCounterValue())
+        for p in parts:
+            merged.merge_with(p)
+        self.assertEquals(merged.count, 1000)
+        self.assertAlmostEqual(merged.mean, mean, delta=1e-5)
+        self.assertAlmostEqual(merged.value["variance"], variance, delta=1e-5)
+
+        # adding a value with a count is the same as adding it count times.
+        weighted = VarianceCounterValue()
+        repeated = VarianceCounterValue()
+        for v, count in [(2, 1), (4, 3), (5, 2), (7, 1), (9, 1)]:
+            weighted.add(v, count)
+            for i in range(count):
+                repeated.add(v)
+        self.assertEquals(weighted.value, repeated.value)
+        self.assertEquals(weighted.value, dict(count=8, mean=5.0, variance=4.0, stddev=2.0))
+
+        c = VarianceTimeCounter("vt")
+        c.report_event("vt", "start", None)
+        c.report_event("vt", "end", None)
+        self.assertEquals(c.get_value().value["count"], 1)
+
+    def test_cardinality_counter(self):
+        FakeCardinalityCounter = fake_time(CardinalityCounter)
+
+        c = FakeCardinalityCounter("users", window_size=10, buckets=5)
+        self.assertEquals(c.get_value().value, 0)
+        for i in range(1000):
+            c.report_event("users", "value", i % 100)
+        self.assertTrue(abs(c.get_value().value - 100) < 100 * 0.05)
+
+        c.now += 5
+        for i in range(20000):
+            c.report_event("users", "value", "user%s" % i)
+        self.assertTrue(abs(c.get_value().value - 20100) < 20100 * 0.05)
+
+        c.now += 20
+        self.assertEquals(c.get_value().value, 0)
+
+    def test_cardinality_counter_value(self):
+        a = CardinalityCounterValue(precision=10)
+        b = CardinalityCounterValue(precision=10)
+        for i in range(5000):
+            a.add(i)
+            b.add(i + 2500)
+        a.merge_with(b)
+        self.assertTrue(abs(a.value - 7500) < 7500 * 0.1)
+        self.assertRaises(Exception, a.merge_with, CardinalityCounterValue(precision=11))
+        self.assertRaises(ValueError, CardinalityCounterValue, precision=20)
+
+    def test_top_k_counter(self):
+        top = TopKCounter("hot_endpoints", k=4)
+        register_counter(top)
+        try:
+            for i in range(100):
+                report_value("hot_endpoints", "/hot")
+                report_value("hot_endpoints", "/hot")
+                report_value("hot_endpoints", "/warm")
+                report_value("hot_endpoints", "/cold%s" % i)
+        finally:
+            unregister_counter(counter=top)
+
+        v = top.get_value().value
+        self.assertEquals(len(v), 4)
+        self.assertEquals(v[0], ("/hot", 200, 0))
+        self.assertEquals(v[1], ("/warm", 100, 0))
+        self.assertTrue(v[2][1] - v[2][2] <= 1 <= v[2][1])  # a cold item
+
+        top.clear()
+        self.assertEquals(top.get_value().value, [])
+
+    def test_top_k_counter_value(self):
+        a = TopKCounterValue(k=2)
+        b = TopKCounterValue(k=2)
+        for item, n in [("x", 10), ("y", 5), ("z", 1)]:
+            a.add(item, n)
+        for item, n in [("y", 8), ("w", 3)]:
+            b.add(item, n)
+        self.assertEquals(a.value, [("x", 10, 0), ("z", 6, 5)])
+
+        a.merge_with(b)
+        # y isn't in a's summary anymore, so it might have occurred up to a's minimal count (6) times.
+        self.assertEquals(a.value, [("y", 14, 6), ("x", 13, 3)])
+
+    def test_concurrency_counter(self):
+        FakeConcurrencyCounter = fake_time(ConcurrencyCounter)
+
+        c = FakeConcurrencyCounter("c", window_size=10, buckets=10)
+        self.assertEquals(c.get_value().value, dict(current=0, peak=0, average=None))
+        c.report_event("c", "start", None)
+        c.now += 2
+        c.report_event("c", "start", None)
+        c.report_event("c", "start", None)
+        c.now += 1
+        c.report_event("c", "end", None)
+        c.report_event("c", "end", None)
+        c.now += 1
+        # 1 for 2 seconds, 3 for a second, 1 for a second.
+        self.assertEquals(c.get_value().value, dict(current=1, peak=3, average=6.0 / 4))
+
+        c.report_event("c", "end", None)
+        c.now += 30
+        self.assertEquals(c.get_value().value, dict(current=0, peak=0, average=0.0))
+
+        c.report_event("c", "start", None)
+        c.now += 30
+        self.assertEquals(c.get_value().value, dict(current=1, peak=1, average=1.0))
+
+        # times which are not on slot boundaries
+        c = FakeConcurrencyCounter("c", window_size=10, buckets=10)
+        c.now = 1000.3
+        c.report_event("c", "start", None)
+        c.report_event("c", "start", None)
+        for now in [1010.8, 1013.45, 1027.99]:
+            c.now = now
+            v = c.get_value().value
+            self.assertEquals(v["current"], 2)
+            self.assertAlmostEqual(v["average"], 2.0)
+
+    def test_concurrency_counter_value(self):
+        a = ConcurrencyCounterValue(1, 3, 1.5)
+        a.merge_with(ConcurrencyCounterValue())
+        a.merge_with(ConcurrencyCounterValue(2, 2, 0.5))
+        self.assertEquals(a.value, dict(current=3, peak=5, average=2.0))
+
+        c = ConcurrencyCounter("conc")
+        register_counter(c)
+        try:
+            @concurrency("conc")
+            def f():
+                self.assertEquals(c.get_value().current, 1)
+            f()
+            self.assertEquals(c.get_value().value["peak"], 1)
+            self.assertEquals(c.get_value().value["current"], 0)
+        finally:
+            unregister_counter(counter=c)
+
+    def test_multi_average_window_counter(self):
+        FakeMultiAverageWindowCounter = fake_time(MultiAverageWindowCounter, 1000.0)
+
+        c = FakeMultiAverageWindowCounter("m", horizons=[("10s", 10.0), ("1m", 60.0)], slot_size=1.0)
+        self.assertEquals(len(c.window.slots), 60)
+        self.assertEquals(c.get_value().value, {"10s": None, "1m": None})
+        c.report_event("m", "value", 1)
+        c.now += 30
+        c.report_event("m", "value", 3)
+        self.assertEquals(c.get_value().value, {"10s": 3.0, "1m": 2.0})
+        c.now += 40
+        self.assertEquals(c.get_value().value, {"10s": None, "1m": 3.0})
+
+        v = SimpleValueReporter()
+        register_reporter(v)
+        c = MultiAverageTimeCounter("mt")
+        register_counter(c)
+        try:
+            @time("mt")
+            def f():
+                pass
+            f()
+            output_report()
+            self.assertEquals(sorted(v.values_wo_metadata.keys()), ["mt.15m", "mt.1m", "mt.5m"])
+        finally:
+            unregister_counter(counter=c)
+            unregister_reporter(v)
+
+    def test_multi_average_counter_value(self):
+        a = MultiAverageCounterValue({"1m": AverageCounterValue(1.0, 1), "5m": AverageCounterValue(None, 0)})
+        a.merge_with(MultiAverageCounterValue({"1m": AverageCounterValue(4.0, 2), "5m": AverageCounterValue(2.0, 1)}))
+        self.assertEquals(a.value, {"1m": 3.0, "5m": 2.0})
+
+    def test_counter_family(self):
+        family = CounterFamily("requests", EventCounter)
+        v = SimpleValueReporter()
+        register_reporter(v)
+        register_counter(family)
+        try:
+            api = family.labels(route="/api", code=200)
+            self.assertTrue(family.labels(code=200, route="/api") is api)
+            api.end()
+            api.end()
+            disable("requests")
+            try:
+                api.end()  # ignored
+            finally:
+                enable("requests")
+            family.labels(route="/", code=500).end()
+            output_report()
+            self.assertEquals(v.values_wo_metadata["requests"], [
+                dict(labels=dict(route="/api", code=200), value=2),
+                dict(labels=dict(route="/", code=500), value=1),
+            ])
+        finally:
+            unregister_counter(counter=family)
+            unregister_reporter(v)
+
+        family.clear()
+        self.assertEquals([child["value"] for child in family.get_value().value], [0, 0])
+
+        timed = CounterFamily("timed", AverageTimeCounter)
+        timed.labels(route="/").start()
+        timed.labels(route="/").end()
+        self.assertTrue(timed.get_value().value[0]["value"] is not None)
+
+        reg = CounterRegistry(EventDispatcher())
+        deltas = CounterFamily("deltas", lambda name: TotalCounter(name, delta=True))
+        sampled = CounterFamily("sampled", lambda name: AverageWindowCounter(name, max_samples=10))
+        reg.add_counter(deltas)
+        reg.add_counter(sampled)
+        deltas.labels(k=1).value(3)
+        for i in range(100):
+            sampled.labels(k=1).value(i)
+        values = reg.get_values().values
+        self.assertEquals(values["deltas"], [dict(labels=dict(k=1), value=3)])
+        self.assertEquals(values["__estimated__"], ["sampled"])
+        # children in delta mode are cleared once collected.
+        self.assertEquals(reg.get_values().values["deltas"], [dict(labels=dict(k=1), value=0)])
+
+    def test_counter_family_cap(self):
+        family = CounterFamily("f", TotalCounter, max_children=2)
+        family.labels(k=1).value(1)
+        family.labels(k=2).value(2)
+        family.labels(k=1).value(1)
+        family.labels(k=3).value(3)  # k=2 is the least recently used
+        self.assertEquals(family.get_value().value, [
+            dict(labels=dict(k=1), value=2),
+            dict(labels=dict(k=3), value=3),
+        ])
+
+    def test_family_counter_value(self):
+        a = FamilyCounterValue({(("k", 1),): AccumulativeCounterValue(1)})
+        a.merge_with(FamilyCounterValue({(("k", 1),): AccumulativeCounterValue(2),
+                                         (("k", 2),): AccumulativeCounterValue(5)}))
+        self.assertEquals(a.value, [dict(labels=dict(k=1), value=3), dict(labels=dict(k=2), value=5)])
+
+    def test_delta_counters(self):
+        FakeFrequencyCounter = fake_time(FrequencyCounter)
+
+        reg = CounterRegistry(EventDispatcher())
+        total = TotalCounter("total", events=["d"], delta=True)
+        freq = FakeFrequencyCounter("freq", window_size=1, events=["d"], delta=True)
+        avg = AverageWindowCounter("avg", events=["d"], delta=True)
+        maximum = MaxWindowCounter("max", events=["d"], delta=True)
+        for c in (total, freq, avg, maximum):
+            reg.add_counter(c)
+        for v in [1, 2, 3]:
+            reg.dispatcher.dispatch_event("d", "value", v)
+        freq.now += 2
+        self.assertEquals(reg.get_values().values, {"total": 6, "freq": 3.0, "avg": 2.0, "max": 3.0})
+
+        # cleared once collected. The next interval starts at collection time.
+        reg.dispatcher.dispatch_event("d", "value", 4)
+        freq.now += 4
+        self.assertEquals(reg.get_values().values, {"total": 4, "freq": 1.0, "avg": 4.0, "max": 4.0})
+        self.assertEquals(reg.get_values().values, {"total": 0, "freq": 0.0, "avg": None, "max": None})
+        # get_value doesn't clear.
+        reg.dispatcher.dispatch_event("d", "value", 5)
+        self.assertEquals(total.get_value().value, 5)
+        self.assertEquals(total.get_value().value, 5)
+
+        self.assertRaises(ValueError, TotalCounter, "d", sharded=True, delta=True)
+
+    def test_max_samples(self):
+        w = DequeWindow(track_max=True, max_samples=1000)
+        for i in range(10000):
+            w.add(1, i)
+        self.assertTrue(len(w.values) < 1000)
+        self.assertTrue(w.estimated())
+        self.assertTrue(abs(w.count() - 10000) < 10000 * 0.2)
+        self.assertEquals(w.sum(), w.count())
+        self.assertEquals(w.max(), 1)
+        w.trim(20000)
+        self.assertEquals((w.count(), w.sum(), w.estimated()), (0, 0.0, False))
+
+        FakeAverageWindowCounter = fake_time(AverageWindowCounter)
+
+        c = FakeAverageWindowCounter("a", window_size=10, max_samples=50)
+        for i in range(49):
+            c.report_event("a", "value", 2)
+        self.assertFalse(c.get_value().estimated)
+        for i in range(1000):
+            c.report_event("a", "value", 2)
+        v = c.get_value()
+        self.assertTrue(v.estimated)
+        self.assertEquals(v.value, 2.0)
+
+        reg = CounterRegistry(EventDispatcher())
+        reg.add_counter(c)
+        reg.add_counter(TotalCounter("t"))
+        self.assertEquals(reg.get_values().values["__estimated__"], ["a"])
+        c.now += 20
+        self.assertFalse("__estimated__" in reg.get_values().values)
+
+        variance = VarianceWindowCounter("v", buckets=None, max_samples=1000)
+        for i in range(10000):
+            variance.report_event("v", "value", i % 2)
+        self.assertTrue(abs(variance.get_value().value["variance"] - 0.25) < 0.05)
+
+    def test_async_dispatch(self):
+        c = AverageTimeCounter("async_time")
+        total = TotalCounter("async_total")
+        register_counter(c)
+        register_counter(total)
+        start_async_dispatch()
+        try:
+            @time("async_time")
+            def f():
+                sleep(0.05)
+
+            def target():
+                for i in range(3):
+                    f()
+                    report_value("async_total", 1)
+
+            threads = [threading.Thread(target=target) for i in range(3)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            # getting the values waits for the queue to be processed.
+            values = GLOBAL_REGISTRY.get_values().values
+            self.assertEquals(values["async_total"], 9)
+            self.assertTrue(0.05 <= values["async_time"] < 0.1)
+
+            stop_async_dispatch()
+            report_value("async_total", 1)
+            self.assertEquals(total.get_value().value, 10)
+        finally:
+            stop_async_dispatch()
+            unregister_counter(counter=c)
+            unregister_counter(counter=total)
+
+    def test_async_event_queue(self):
+        FakeWindowCounter = fake_time(WindowCounter, 1000.0)
+
+        dispatcher = EventDispatcher()
+        w = FakeWindowCounter("w", window_size=10)
+        dropped = TotalCounter("pycounters.dropped_events")
+        dispatcher.add_listener(w)
+        dispatcher.add_listener(dropped)
+
+        queue = AsyncEventQueue(dispatcher, max_events=3)  # not started - events are only dispatched by stop()
+        for i in range(5):
+            queue.put("w", "end", None)
+        self.assertEquals(queue.dropped, 2)
+        self.assertEquals(w.get_value().value, 0.0)
+        queue.stop()
+        self.assertEquals(dropped.get_value().value, 2)
+        # events keep their original time rather than the counter's (fake) time when dispatched.
+        self.assertEquals(len(w.values), 3)
+        self.assertTrue(w.times[0] > 1000.0)
+
+        # an event which raced with stop() is dispatched by the reporting thread, keeping its context.
+        base.EVENT_CONTEXT.weight = 2
+        try:
+            queue.put("w", "end", None)
+            self.assertEquals(base.EVENT_CONTEXT.weight, 2)
+        finally:
+            base.EVENT_CONTEXT.weight = 1
+        self.assertEquals(len(w.values), 4)
+
+        self.assertRaises(ValueError, AsyncEventQueue, dispatcher, policy="wait")
+
+    def test_async_event_queue_flush(self):
+        dispatcher = EventDispatcher()
+        dispatched = []
+        flushing = threading.Event()
+
+        class Listener(BaseListener):
+            def report_event(self, name, property, param):
+                dispatched.append(name)
+                if name == "early" and param == 0:
+                    flushing.wait()
+                    sleep(0.05)
+                    # queued while flush is waiting: flush shouldn't wait for these.
+                    for i in range(100):
+                        queue.put("late", "value", i)
+                elif name == "late":
+                    sleep(0.01)
+
+        dispatcher.add_listener(Listener(events=["early", "late"]))
+        queue = AsyncEventQueue(dispatcher)
+        for i in range(3):
+            queue.put("early", "value", i)
+        queue.start()
+        try:
+            flushing.set()
+            queue.flush()
+            self.assertEquals(dispatched.count("early"), 3)
+            self.assertTrue(dispatched.count("late") < 100)
+        finally:
+            queue.stop()
+        self.assertEquals(dispatched.count("late"), 100)
+
+    def test_sampling(self):
+        events = EventCounter("sampled_events", events=["sampled"])
+        frequency_counter = FrequencyCounter("sampled_frequency", events=["sampled"])
+        timer = AverageTimeCounter("sampled_time", events=["sampled"])
+        register_counter(events)
+        register_counter(frequency_counter)
+        register_counter(timer)
+        try:
+            @report_start_end("sampled", sample_rate=0.1)
+            def f():
+                pass
+
+            random.seed(1)
+            for i in range(10000):
+                f()
+            v = events.get_value()
+            self.assertEquals(v.sample_rate, 0.1)
+            self.assertTrue(abs(v.value - 10000) < 10000 * 0.1)
+            self.assertEquals(frequency_counter.get_value().sample_rate, 0.1)
+            self.assertTrue(len(timer.values) < 2000)
+
+            events.clear()
+            with report_start_end("sampled", sample_rate=0.5):
+                pass
+            self.assertTrue(events.get_value().value in (0, 2.0))
+        finally:
+            unregister_counter(counter=events)
+            unregister_counter(counter=frequency_counter)
+            unregister_counter(counter=timer)
+
+        counter = EventCounter("sampled_at_registration")
+        register_counter(counter, sample_rate=0.5)
+        try:
+            @report_start_end("sampled_at_registration")
+            def g():
+                pass
+
+            for i in range(2000):
+                g()
+            v = counter.get_value()
+            self.assertEquals(v.sample_rate, 0.5)
+            self.assertTrue(abs(v.value - 2000) < 2000 * 0.1)
+        finally:
+            unregister_counter(counter=counter)
+            event_handle("sampled_at_registration").sample_rate = 1.0
+
+        self.assertRaises(ValueError, report_start_end, "sampled", sample_rate=0)
+
+    def test_sampling_scales_counts(self):
+        summary = SummaryTimeCounter("scaled_summary", events=["scaled"])
+        unbucketed = SummaryTimeCounter("scaled_unbucketed", events=["scaled"], buckets=None)
+        histogram = HistogramTimeCounter("scaled_histogram", events=["scaled"])
+        rate = EWMARateCounter("scaled_rate", events=["scaled"])
+        conc = ConcurrencyCounter("scaled_concurrency", events=["scaled"])
+        average = AverageTimeCounter("scaled_average", events=["scaled"])
+        bucketed_average = AverageTimeCounter("scaled_bucketed_average", events=["scaled"], buckets=10)
+        variance = VarianceTimeCounter("scaled_variance", events=["scaled"])
+        unbucketed_variance = VarianceTimeCounter("scaled_unbucketed_variance", events=["scaled"], buckets=None)
+        sampled_counters = [summary, unbucketed, histogram, rate, conc, average, bucketed_average, variance,
+                            unbucketed_variance]
+        for c in sampled_counters:
+            register_counter(c)
+        try:
+            @report_start_end("scaled", sample_rate=0.1)
+            def f():
+                pass
+
+            random.seed(1)
+            for i in range(10000):
+                f()
+            for c in [summary, unbucketed, histogram, variance, unbucketed_variance]:
+                self.assertTrue(abs(c.get_value().value["count"] - 10000) < 10000 * 0.1)
+            for c in [average, bucketed_average]:
+                self.assertEquals(c.get_value()._count, summary.get_value().value["count"])
+            self.assertEquals(rate.tick_count, summary.get_value().value["count"])
+            self.assertEquals(conc.get_value().current, 0)
+            self.assertEquals(summary.sample_rate, 0.1)
+
+            # once events are no longer sampled, neither is the rate
+            summary.report_event("scaled", "value", 1.0)
+            self.assertEquals(summary.sample_rate, None)
+        finally:
+            for c in sampled_counters:
+                unregister_counter(counter=c)
+
+        counter = EventCounter("sampled_delta", delta=True)
+        register_counter(counter)
+        try:
+            with report_start_end("sampled_delta", sample_rate=1.0 / 3):
+                pass
+            counter.collect_value()
+            self.assertEquals(counter.sample_rate, None)
+        finally:
+            unregister_counter(counter=counter)
+
+    def test_sampled_value_merge(self):
+        a = AccumulativeCounterValue(100.0, 0.1)  # 10 events seen
+        a.merge_with(AccumulativeCounterValue(10))  # 10 events seen
+        self.assertEquals(a.value, 110.0)
+        self.assertAlmostEqual(a.sample_rate, 20 / 110.0)
+
+        merged = AccumulativeCounterValue.merge_groups([[AccumulativeCounterValue(10),
+                                                         AccumulativeCounterValue(100.0, 0.1)]])[0]
+        self.assertEquals(merged.value, 110.0)
+        self.assertAlmostEqual(merged.sample_rate, 20 / 110.0)
+
+    def test_disable(self):
+        events = EventCounter("switched.events", events=["switched.f"])
+        values = TotalCounter("switched.values", events=["switched.value"])
+        register_counter(events)
+        register_counter(values)
+        try:
+            @report_start_end("switched.f")
+            def f():
+                return 1
+
+            disable()
+            try:
+                self.assertEquals(f(), 1)
+                with report_start_end("switched.f"):
+                    enable()  # the context manager should not report an unmatched end
+                self.assertEquals(events.get_value().value, None)
+            finally:
+                enable()
+
+            disable("switched.")
+            try:
+                self.assertFalse(is_enabled("switched.f"))
+                self.assertTrue(is_enabled("other"))
+                f()
+                report_value("switched.value", 3)
+                enable()  # prefixes stay disabled
+                f()
+                self.assertEquals(events.get_value().value, None)
+                self.assertEquals(values.get_value().value, None)
+            finally:
+                enable("switched.")
+
+            f()
+            report_value("switched.value", 3)
+            self.assertEquals(events.get_value().value, 1)
+            self.assertEquals(values.get_value().value, 3)
+        finally:
+            unregister_counter(counter=events)
+            unregister_counter(counter=values)
+
+    def test_disable_in_flight(self):
+        c = ConcurrencyCounter("inflight")
+        timer = AverageTimeCounter("inflight_time", events=["inflight"])
+        register_counter(c)
+        register_counter(timer)
+        try:
+            @concurrency("inflight")
+            def f():
+                disable()
+
+            try:
+                f()  # the end is reported as the start was
+            finally:
+                enable()
+            self.assertEquals(c.get_value().current, 0)
+            self.assertEquals(timer.timer._tasks, {})
+
+            cm = report_start_end("inflight")
+            try:
+                with cm:
+                    disable()
+                    with cm:
+                        enable()
+                        with cm:
+                            disable()
+            finally:
+                enable()
+            self.assertEquals(c.get_value().current, 0)
+            self.assertEquals(c.get_value().peak, 2)
+        finally:
+            unregister_counter(counter=c)
+            unregister_counter(counter=timer)
+
     def test_total_counter(self):
         test = TotalCounter("test")
         self.assertEquals(test.get_value().value, None)
@@ -300,6 +1305,55 @@ class CounterTests(unittest.TestCase):
         test.report_event("test", "value", 1)
         self.assertEquals(test.get_value().value, 1)
 
+    def test_sharded_counters(self):
+        total = TotalCounter("test", sharded=True)
+        events = EventCounter("test", sharded=True)
+        self.assertEquals(total.get_value().value, None)
+
+        def target():
+            for i in range(100):
+                total.report_event("test", "value", 2)
+                events.report_event("test", "end", None)
+
+        threads = [threading.Thread(target=target) for _ in range(4)]
+        for t in threads:
+            t.start()
+        total.report_event("test", "value", 1)
+        for t in threads:
+            t.join()
+
+        self.assertEquals(total.get_value().value, 801)
+        self.assertEquals(events.get_value().value, 400)
+        # shards of exited threads are folded in
+        self.assertEquals(total.get_value().value, 801)
+
+        total.clear()
+        self.assertEquals(total.get_value().value, 0)
+        total.report_event("test", "value", 1)
+        self.assertEquals(total.get_value().value, 1)
+
+    def test_sharded_frequency_counter(self):
+        class FakeFrequencyCounter(FrequencyCounter):
+
+            i = 0
+
+            def _get_current_time(self):
+                self.i = self.i + 1
+                return self.i
+
+        c = FakeFrequencyCounter("c", window_size=10, sharded=True)
+        c.report_event("c", "end", None)  # time 1
+
+        t = threading.Thread(target=lambda: c.report_event("c", "value", 2))  # time 2
+        t.start()
+        t.join()
+
+        # window starts at 3 - 10, value is taken at 4
+        self.assertEquals(c.get_value().value, 1.0)
+        c.i = 11
+        # window starts at 12 - 10, only the occurrences of the exited thread remain
+        self.assertEquals(c.get_value().value, 2.0 / (13 - 2))
+
     def test_basic_reporter(self):
 
         test1 = EventCounter("test1", events=["test_event"])
@@ -327,6 +1381,69 @@ class CounterTests(unittest.TestCase):
             unregister_counter(counter=test1)
             unregister_reporter(v)
 
+    def test_dispatcher_listener_snapshots(self):
+        dispatcher = EventDispatcher()
+        events = []
+
+        class Listener(BaseListener):
+            def report_event(self, name, property, param):
+                events.append((name, property, param))
+                if param == 1:
+                    # changes to listeners don't affect events already being dispatched.
+                    dispatcher.add_listener(late_listener)
+
+        late_listener = Listener(events=["a"])
+        dispatcher.add_listener(Listener(events=["a"]))
+
+        dispatcher.dispatch_event("a", "value", 1)
+        self.assertEqual(events, [("a", "value", 1)])
+
+        dispatcher.dispatch_event("a", "value", 2)
+        self.assertEqual(len(events), 3)
+
+        dispatcher.remove_listener(late_listener)
+        self.assertRaises(KeyError, dispatcher.remove_listener, late_listener)
+        dispatcher.dispatch_event("a", "value", 3)
+        self.assertEqual(len(events), 4)
+
+    def test_event_handle(self):
+        handle = event_handle("h")
+        self.assertTrue(handle is event_handle("h"))
+
+        handle.value(1)  # nothing listens yet
+
+        c = TotalCounter("h")
+        register_counter(c)
+        try:
+            handle.value(2)
+            self.assertEqual(c.get_value().value, 2)
+
+            events = []
+            with EventCatcher(events):
+                handle.start()
+                handle.end()
+                handle.value(3)
+
+            self.assertEqual(events, [("h", "start", None), ("h", "end", None), ("h", "value", 3)])
+            self.assertEqual(c.get_value().value, 5)
+        finally:
+            unregister_counter(counter=c)
+
+        handle.value(4)
+        self.assertEqual(c.get_value().value, 5)
+
+    def test_dynamic_event_names(self):
+        c = TotalCounter("tenant.1")
+        register_counter(c)
+        try:
+            handles = len(base._EVENT_HANDLES)
+            for i in range(1000):
+                report_value("tenant.%d" % i, 1)
+            self.assertEquals(len(base._EVENT_HANDLES), handles + 1)  # only the name with a counter
+            self.assertEquals(c.get_value().value, 1)
+        finally:
+            unregister_counter(counter=c)
+
     def test_registry_get_values(self):
         reg = CounterRegistry(EventDispatcher())
         test1 = EventCounter("test1")